@@ -4,8 +4,19 @@
 
 __version__ = "2.1.0"
 
+import array
+import collections.abc
+import contextlib
+import copy
+import importlib
+import inspect
+import itertools
+import mmap
 import os
+import re
 import sys
+import threading
+import time
 
 
 # Base class for all exceptions raised by the library.
@@ -21,14 +32,17 @@ class InvalidUnicode(ArgsError): pass
 
 
 # An ArgParser instance is responsible for registering options and commands
-# and parsing the input stream of raw arguments.
+# and parsing the input stream of raw arguments. Parsing never modifies the parser
+# itself -- each call to parse() returns a fresh ParseResult instance -- so once
+# registration is complete a single parser can be shared freely between threads.
 class ArgParser:
 
-    # Specifying a helptext string activates an automatic --help flag.
+    # Specifying a helptext string activates an automatic --help flag. The helptext can also be
+    # a callable which is passed the parser and returns the helptext string when it's printed.
     # Specifying a version string activates an automatic --version flag.
     def __init__(self, helptext=None, version=None):
 
-        # Help text for the application or command.
+        # Help text for the application or command, or a callable returning the help text.
         self.helptext = helptext
 
         # Application version.
@@ -40,178 +54,776 @@ class ArgParser:
         # Stores registered Flag instances indexed by name.
         self.flags = {}
 
-        # Stores positional arguments parsed from the input stream.
-        self.args = []
-
         # Stores registered command parsers indexed by command name.
         self.commands = {}
 
-        # Stores the command name, if a command was found.
-        self.command_name = None
-
-        # Stores the command parser, if a command was found.
-        self.command_parser = None
+        # Stores the result of the most recent call to parse(), created on demand.
+        self._result = None
 
         # Stores a command parser's callback function.
         self.callback = None
 
+        # Stores a command parser's loader, if its registration has been deferred.
+        self.loader = None
+
+        # Stores the spec generation shared by the parser and its command parsers.
+        self._tree = _ParserTree()
+
         # Toggles support for an automatic 'help' command that prints subcommand helptext.
         self.enable_help_command = False
 
         # Deprecated.
         self.help_command = False
 
+        # Maps exact flag and option tokens to Flag and Option instances if compiled.
+        self._dispatch = None
+
+        # Toggles expansion of @path arguments into the arguments stored in the file at path.
+        self.enable_response_files = False
+
+        # Toggles caching of tokenized response files by path and modification time.
+        self.cache_response_files = False
+
+        # Path of a TOML, INI, or JSON file supplying fallback values for options registered
+        # with a `config` key. Commands inherit the path when registered.
+        self.config_file = None
+
+        # If set, snapshots of the config file's values are cached in this directory.
+        self.config_cache_dir = None
+
+        # Stores an Instrumentation instance if parsing should be instrumented.
+        self.instrumentation = None
+
+        # Stores a ParseCache instance if parse outcomes should be cached by argument list.
+        self.parse_cache = None
+
+        # Toggles support for unique-prefix abbreviations of long-form flag and option names
+        # and command names. Commands inherit the setting when registered.
+        self.enable_abbreviations = False
+
+        # The maximum number of "did you mean" suggestions for an unrecognised name, and the
+        # maximum edit distance of a suggestion from the unrecognised name.
+        self.max_suggestions = 3
+        self.suggestion_distance = 2
+
+        # Stores lookup indexes over flag, option, and command names and the generated namespace
+        # class, built on demand and cleared when a flag, option, or command is registered.
+        self._indexes = {}
+
+        # Stores the parser's options with batch converters.
+        self._batches = []
+
+        # Stores the parser's compiled constraints, if any have been registered.
+        self._constraints = None
+
+        # If true, the application's command line arguments are parsed as bytes rather than
+        # being decoded. String-valued options and positional arguments are returned as bytes.
+        self.bytes_mode = False
+
     # -------------- #
     # Setup methods. #
     # -------------- #
 
     # Register a new flag.
-    def flag(self, name):
-        flag = Flag()
-        for alias in name.split():
+    def flag(self, name, helptext=None):
+        aliases = name.split()
+        flag = Flag(aliases[0] if aliases else name, helptext)
+        for alias in aliases:
             self.flags[alias] = flag
-
-    # Register a new option.
-    def option(self, name, type=str, default=None):
-        option = Option(type, default)
-        for alias in name.split():
+            self._add_dispatch(alias, flag)
+        self._spec_changed()
+
+    # Register a new option. If `lazy` is true, the option's values are stored as raw strings
+    # and only converted to `type` when first retrieved. The `complete` argument declares how
+    # the option's value should be completed by generated shell completion scripts -- either
+    # "file", "dir", or a list of choices. If `type` is a coroutine function, the option is
+    # always lazy and its values are awaited by parse_async(). If the option isn't found, its
+    # value falls back to the environment variable `env`, then to the `config` key in the
+    # parser's config file, then to `default`. If `type` is a Batch instance, the option's raw
+    # values are collected while parsing and converted together in a single call at the end.
+    # The `helptext` string describes the option in help text rendered by HelpGenerator.
+    def option(
+        self, name, type=str, default=None, lazy=False, complete=None, env=None, config=None,
+        helptext=None,
+    ):
+        aliases = name.split()
+        lazy = lazy or inspect.iscoroutinefunction(type)
+        option = Option(
+            aliases[0] if aliases else name, type, default, lazy, complete, env, config, helptext
+        )
+        if option.batch:
+            self._batches.append(option)
+        for alias in aliases:
             self.options[alias] = option
-
-    # Register a new command.
-    def command(self, name, helptext=None, callback=None):
+            if alias not in self.flags:
+                self._add_dispatch(alias, option)
+        self._spec_changed()
+
+    # Register a new command. If a `loader` is specified, registering the command's flags,
+    # options, and subcommands is deferred until the command is actually used. The loader
+    # can be a callable or a 'module:function' string naming a callable; it's called with the
+    # command's parser as its only argument and can also set the parser's callback.
+    def command(self, name, helptext=None, callback=None, loader=None):
         self.help_command = True
         self.enable_help_command = True
         cmd_parser = ArgParser(helptext)
         cmd_parser.callback = callback
+        cmd_parser.loader = loader
+        cmd_parser.enable_abbreviations = self.enable_abbreviations
+        cmd_parser.config_file = self.config_file
+        cmd_parser.config_cache_dir = self.config_cache_dir
+        cmd_parser._tree = self._tree
         for alias in name.split():
             self.commands[alias] = cmd_parser
+        self._spec_changed()
+        if self._dispatch is not None:
+            cmd_parser.compile()
         return cmd_parser
 
+    # Clear the parser's lookup indexes after a flag, option, command, or constraint is
+    # registered. Cached parse outcomes are invalidated for every parser in the tree as the
+    # registration may be on a command parser reached from a parser with a cache.
+    def _spec_changed(self):
+        self._indexes.clear()
+        self._tree.generation += 1
+        if self.parse_cache is not None:
+            self.parse_cache.clear()
+
+    # Opt in to a faster parsing path for this parser and its commands. Each exact flag or
+    # option token, e.g. '--foo' or '-f', is mapped directly to the flag or option it
+    # triggers so matching tokens skip the general-purpose classification logic. Flags and
+    # options registered after compilation are added to the dispatch table automatically.
+    # Returns the parser to allow chaining.
+    def compile(self):
+        self._dispatch = {}
+        for alias, option in self.options.items():
+            self._add_dispatch(alias, option)
+        for alias, flag in self.flags.items():
+            self._add_dispatch(alias, flag)
+        for cmd_parser in self.commands.values():
+            cmd_parser.compile()
+        return self
+
+    # Run the parser's loader, if it hasn't been run already.
+    def _load(self):
+        if self.loader is None:
+            return
+        with _loader_lock:
+            if (loader := self.loader) is not None:
+                if isinstance(loader, str):
+                    module_name, _, func_name = loader.partition(":")
+                    loader = getattr(importlib.import_module(module_name), func_name)
+                # No outcome involving the command can have been cached before it was loaded,
+                # so the loader's registrations don't invalidate cached outcomes.
+                generation = self._tree.generation
+                loader(self)
+                self._tree.generation = generation
+                self.loader = None
+
+    # Add the tokens for a flag or option alias to the dispatch table if compiled.
+    def _add_dispatch(self, alias, target):
+        if self._dispatch is None or "=" in alias:
+            return
+        self._dispatch[f"--{alias}"] = target
+        if len(alias) == 1 and not alias.isdigit():
+            self._dispatch[f"-{alias}"] = target
+
+    # ------------------- #
+    # Constraint methods. #
+    # ------------------- #
+
+    # Constraints are checked in a single pass after the parser's arguments have been parsed,
+    # before any command callback is called. All violations are reported together. Each name
+    # is compiled to a bit in a mask when the constraint is registered, so names must already
+    # be registered. Raises InvalidName if a name isn't registered.
+
+    # Require each of the specified flags or options to be found.
+    def require(self, *names):
+        self._compiled_constraints().required |= self._mask(names)
+        self._spec_changed()
+
+    # Allow at most one of the specified flags or options to be found.
+    def exclusive(self, *names):
+        self._compiled_constraints().exclusive.append(self._mask(names))
+        self._spec_changed()
+
+    # Require each of the `dependencies` to be found if the flag or option `name` is found.
+    def requires(self, name, *dependencies):
+        constraints = self._compiled_constraints()
+        constraints.requires.append((self._mask([name]), self._mask(dependencies)))
+        self._spec_changed()
+
+    # Restrict the values of an option to the range `min` to `max` inclusive and/or to the
+    # collection of `choices`. The values are compared after conversion. The values of options
+    # with async converters are checked by parse_async() once they've been awaited.
+    def limit(self, name, min=None, max=None, choices=None):
+        if (option := self.options.get(name)) is None:
+            raise InvalidName(f"'{name}' is not a recognised option name")
+        constraints = self._compiled_constraints()
+        if inspect.iscoroutinefunction(option.type):
+            constraints.async_limits.append((option, min, max, choices))
+        else:
+            constraints.limits.append((option, min, max, choices))
+        self._spec_changed()
+
+    # Returns the parser's compiled constraints, creating them on first use.
+    def _compiled_constraints(self):
+        if self._constraints is None:
+            self._constraints = _Constraints()
+        return self._constraints
+
+    # Returns the bitmask for the specified flag and option names, assigning a bit to each flag
+    # or option on first use.
+    def _mask(self, names):
+        bits = self._compiled_constraints().bits
+        mask = 0
+        for name in names:
+            if (target := self.flags.get(name) or self.options.get(name)) is None:
+                raise InvalidName(f"'{name}' is not a recognised flag or option name")
+            if target not in bits:
+                bits[target] = 1 << len(bits)
+            mask |= bits[target]
+        return mask
+
+    # Check the result against the parser's constraints, exiting with an error listing every
+    # violation if any are found.
+    def _check_constraints(self, result):
+        constraints = self._constraints
+        bits = constraints.bits
+        found = 0
+        for flag in result._counts:
+            found |= bits.get(flag, 0)
+        for option, values in result._values.items():
+            if values:
+                found |= bits.get(option, 0)
+
+        errors = []
+        if missing := constraints.required & ~found:
+            errors.extend(f"{name} is required" for name in constraints.names(missing))
+        for mask in constraints.exclusive:
+            if (both := found & mask) & (both - 1):
+                errors.append(f"{' and '.join(constraints.names(both))} cannot be used together")
+        for mask, dependencies in constraints.requires:
+            if found & mask and (missing := dependencies & ~found):
+                names = " and ".join(constraints.names(missing))
+                errors.append(f"{constraints.names(mask)[0]} requires {names}")
+        errors.extend(self._limit_errors(result, constraints.limits))
+
+        if errors:
+            self.exit_error("; ".join(errors))
+
+    # Returns a list of the violations of the option value `limits` in the result.
+    def _limit_errors(self, result, limits):
+        errors = []
+        for option, min, max, choices in limits:
+            for value in result._option_values(option) if option in result._values else ():
+                if (min is not None and value < min) or (max is not None and value > max):
+                    if max is None:
+                        errors.append(f"{_token(option.name)} must be at least {min}, found {value}")
+                    elif min is None:
+                        errors.append(f"{_token(option.name)} must be at most {max}, found {value}")
+                    else:
+                        errors.append(
+                            f"{_token(option.name)} must be between {min} and {max}, found {value}"
+                        )
+                elif choices is not None and value not in choices:
+                    names = ", ".join(map(str, choices))
+                    errors.append(f"{_token(option.name)} must be one of {names}, found {value}")
+        return errors
+
     # ------------------- #
     # Inspection methods. #
     # ------------------- #
 
+    # These methods and properties report the result of the most recent call to parse().
+    # Code which shares a parser between threads should use the ParseResult instance
+    # returned by parse() instead.
+
     # Returns the number of times the specified flag or option has been found.
     def count(self, name):
-        if flag := self.flags.get(name):
-            return flag.count
-        elif option := self.options.get(name):
-            return len(option.values)
-        else:
-            raise InvalidName(f"'{name}' is not a recognised flag or option name")
+        return self._last_result().count(name)
 
     # Returns true if the specified flag or option was found.
     def found(self, name):
-        return self.count(name) > 0
+        return self._last_result().found(name)
 
     # Returns the value of the specified option.
     def value(self, name):
-        if option := self.options.get(name):
-            return option.value
-        else:
-            raise InvalidName(f"'{name}' is not a recognised option name")
+        return self._last_result().value(name)
 
     # Returns the specified option's list of values.
     def values(self, name):
-        if option := self.options.get(name):
-            return option.values
-        else:
-            raise InvalidName(f"'{name}' is not a recognised option name")
+        return self._last_result().values(name)
+
+    # Returns the result as an instance of a namespace class generated from the parser's spec.
+    def namespace(self):
+        return self._last_result().namespace()
+
+    # Returns the result of the most recent call to parse(), or an empty result.
+    def _last_result(self):
+        if self._result is None:
+            self._result = ParseResult(self)
+        return self._result
+
+    # Returns the list of positional arguments.
+    @property
+    def args(self):
+        return self._last_result().args
+
+    # Returns the command name, if a command was found.
+    @property
+    def command_name(self):
+        return self._last_result().command_name
+
+    # Returns the command's ParseResult, if a command was found.
+    @property
+    def command_parser(self):
+        return self._last_result().command_parser
 
     # ------------------ #
     # Parsing machinery. #
     # ------------------ #
 
-    # Parse a list of string arguments.
+    # Parse a list of string arguments. Returns a new ParseResult instance.
     def parse(self, args=None):
-        argstrings = self._get_argstrings() if args is None else args
-        self._parse_stream(ArgStream(argstrings))
+        return self._parse(args)
+
+    # Parse an iterable of string arguments from a coroutine, returning a ParseResult instance.
+    # Option values with async converters are awaited, then command callbacks are called in
+    # the same order as parse() would call them -- innermost command first -- with any
+    # awaitable returned by a callback being awaited before the next callback is called.
+    async def parse_async(self, args=None):
+        pending = []
+        result = self._parse(args, pending)
+        await result._convert_async()
+        instr = result._instr
+        for callback, name, cmd_result in pending:
+            start = time.perf_counter()
+            ret = callback(name, cmd_result)
+            if inspect.isawaitable(ret):
+                await ret
+            if instr is not None:
+                duration = time.perf_counter() - start
+                instr._add_time("callbacks", duration)
+                instr._emit("callback", name, duration)
+        return result
+
+    # Parse the arguments into a new ParseResult. If `pending` is not None, command callbacks
+    # are appended to it instead of being called.
+    def _parse(self, args=None, pending=None):
+        instr = self.instrumentation or _env_instrumentation()
+        if args is not None:
+            argstrings = args
+        elif instr is None:
+            argstrings = self._get_argstrings()
+        else:
+            start = time.perf_counter()
+            argstrings = self._get_argstrings()
+            instr._add_time("argstrings", time.perf_counter() - start)
+        if self.enable_response_files:
+            argstrings = _expand_response_files(argstrings, self.cache_response_files)
+            if self.parse_cache is not None:
+                argstrings = list(argstrings)
+        if self.parse_cache is not None and type(argstrings) in (list, tuple):
+            return self._parse_cached(tuple(argstrings), argstrings, pending, instr)
+        result = ParseResult(self, pending, instr)
+        if instr is None:
+            self._parse_stream(_arg_stream(argstrings), result)
+        else:
+            start = time.perf_counter()
+            self._parse_stream(_arg_stream(argstrings), result)
+            instr._add_time("parse", time.perf_counter() - start)
+        result._bind()
+        return result
+
+    # Parse an argument list or tuple using the parser's ParseCache, keyed by the tuple `key`.
+    # On a miss, the arguments are parsed with callbacks deferred so the outcome can be cached
+    # before any callback sees it. On a hit, a fresh chain of results is restored from the
+    # cached outcome. Callbacks are called in either case unless the caller is deferring them.
+    # Outcomes which involved an impure converter or produced a mutable converted value are not
+    # cached.
+    def _parse_cached(self, key, args, pending, instr):
+        cache = self.parse_cache
+        generation = self._tree.generation
+        deferred = []
+        if (snapshot := cache._get(key, generation)) is None:
+            result = ParseResult(self, deferred, instr)
+            if instr is None:
+                self._parse_stream(_arg_stream(args), result)
+            else:
+                start = time.perf_counter()
+                self._parse_stream(_arg_stream(args), result)
+                instr._add_time("parse", time.perf_counter() - start)
+            if not result._impure() and result._immutable():
+                cache._put(key, _CachedOutcome(_snapshot_levels(result)), generation)
+        else:
+            result = snapshot.restore(instr)
+            parent = result
+            while (child := parent.command_parser) is not None:
+                if callback := child.parser.callback:
+                    deferred.append((callback, parent.command_name, child))
+                parent = child
+            deferred.reverse()
+
+        result._bind()
+        if pending is not None:
+            pending.extend(deferred)
+            return result
+        for callback, name, cmd_result in deferred:
+            if instr is None:
+                callback(name, cmd_result)
+            else:
+                start = time.perf_counter()
+                callback(name, cmd_result)
+                duration = time.perf_counter() - start
+                instr._add_time("callbacks", duration)
+                instr._emit("callback", name, duration)
+        return result
+
+    # Parse an iterable of argument lists in bulk, returning a ParseColumns instance with one
+    # row per argument list. Command callbacks are not called. Argument lists which would
+    # cause the parser to exit are recorded in the status column rather than exiting. The
+    # input is consumed in chunks of `chunksize` argument lists; specifying a number of
+    # `processes` parses the chunks in parallel, in which case the parser must be picklable.
+    def parse_many(self, argvs, chunksize=10000, processes=None):
+        argvs = iter(argvs)
+        chunks = iter(lambda: list(itertools.islice(argvs, chunksize)), [])
+        columns = ParseColumns(self)
+        if processes is None:
+            for chunk in chunks:
+                columns._extend(_parse_chunk(self, chunk))
+        else:
+            import concurrent.futures
+            executor = concurrent.futures.ProcessPoolExecutor(
+                processes, initializer=_init_worker, initargs=(self,)
+            )
+            with executor:
+                for state in executor.map(_parse_worker_chunk, chunks):
+                    columns._extend(ParseColumns._from_worker_state(state))
+        return columns
+
+    # Parse a stream of string arguments into the specified ParseResult instance. The
+    # `is_first_arg` argument is false if resuming after the first argument has been parsed.
+    # The loop is chosen once per parser so the common case, string arguments parsed without
+    # instrumentation or snapshots, doesn't pay for those features on every token.
+    def _parse_stream(self, stream, result, is_first_arg=True):
+        self._load()
+        if result._instr is not None or result._snapshots is not None or stream.is_bytes():
+            self._parse_stream_general(stream, result, is_first_arg)
+        elif self._dispatch:
+            self._parse_stream_compiled(stream, result, is_first_arg)
+        else:
+            self._parse_stream_plain(stream, result, is_first_arg)
+        if result.command_parser is None and (self._batches or self._constraints is not None):
+            self._finish(result)
 
-    # Parse a stream of string arguments.
-    def _parse_stream(self, stream):
+    # Parse a stream of string arguments without instrumentation or snapshots.
+    def _parse_stream_plain(self, stream, result, is_first_arg):
         enable_help_command = self.enable_help_command or self.help_command
-        is_first_arg = True
 
         while stream.has_next():
             arg = stream.next()
 
             if arg == "--":
-                while stream.has_next():
-                    self.args.append(stream.next())
+                self._handle_separator(stream, result)
 
             elif arg.startswith("--"):
                 if "=" in arg:
-                    self._handle_equals_opt(arg[2:])
+                    self._handle_equals_opt(arg[2:], result)
                 else:
-                    self._handle_long_opt(arg[2:], stream)
+                    self._handle_long_opt(arg[2:], stream, result)
 
             elif arg.startswith("-"):
                 if arg == '-' or arg[1].isdigit():
-                    self.args.append(arg)
+                    result.args.append(arg)
                 elif "=" in arg:
-                    self._handle_equals_opt(arg[1:])
+                    self._handle_equals_opt(arg[1:], result)
                 else:
-                    self._handle_short_opt(arg[1:], stream)
-
-            elif is_first_arg and arg in self.commands:
-                self.command_name = arg
-                self.command_parser = self.commands[arg]
-                self.command_parser._parse_stream(stream)
-                if self.command_parser.callback:
-                    self.command_parser.callback(arg, self.command_parser)
-
-            elif is_first_arg and enable_help_command and arg == "help":
-                if stream.has_next():
-                    name = stream.next()
-                    if name in self.commands:
-                        self.commands[name].exit_help()
-                    else:
-                        self.exit_error(f"'{name}' is not a recognised command")
+                    self._handle_short_opt(arg[1:], stream, result)
+
+            elif is_first_arg and (name := self._expand_command(arg)) in self.commands:
+                self._handle_command(name, stream, result)
+
+            elif is_first_arg and enable_help_command and name == "help":
+                self._handle_help_command(stream)
+
+            else:
+                result.args.append(arg)
+
+            is_first_arg = False
+
+    # Parse a stream of string arguments for a compiled parser without instrumentation or
+    # snapshots. Tokens in the dispatch table skip the general-purpose classification logic.
+    def _parse_stream_compiled(self, stream, result, is_first_arg):
+        enable_help_command = self.enable_help_command or self.help_command
+        dispatch = self._dispatch
+
+        while stream.has_next():
+            arg = stream.next()
+            target = dispatch.get(arg)
+
+            if type(target) is Flag:
+                result._counts[target] = result._counts.get(target, 0) + 1
+
+            elif target is not None and stream.has_next():
+                self._append_value(target, stream.next(), result)
+
+            elif arg == "--":
+                self._handle_separator(stream, result)
+
+            elif arg.startswith("--"):
+                if "=" in arg:
+                    self._handle_equals_opt(arg[2:], result)
+                else:
+                    self._handle_long_opt(arg[2:], stream, result)
+
+            elif arg.startswith("-"):
+                if arg == '-' or arg[1].isdigit():
+                    result.args.append(arg)
+                elif "=" in arg:
+                    self._handle_equals_opt(arg[1:], result)
                 else:
-                    self.exit_error("missing argument for the help command")
+                    self._handle_short_opt(arg[1:], stream, result)
+
+            elif is_first_arg and (name := self._expand_command(arg)) in self.commands:
+                self._handle_command(name, stream, result)
+
+            elif is_first_arg and enable_help_command and name == "help":
+                self._handle_help_command(stream)
 
             else:
-                self.args.append(arg)
+                result.args.append(arg)
 
             is_first_arg = False
 
-    # Parse an argument of the form --name=value or -n=value.
-    def _handle_equals_opt(self, arg):
+    # Parse a stream of string or bytes arguments, recording instrumentation events and
+    # snapshots if enabled. Bytes arguments are decoded for matching against flag, option,
+    # and command names; positional arguments and option values keep their original bytes.
+    def _parse_stream_general(self, stream, result, is_first_arg):
+        enable_help_command = self.enable_help_command or self.help_command
+        dispatch = self._dispatch or {}
+        instr = result._instr
+        snapshots = result._snapshots
+
+        while stream.has_next():
+            if snapshots is not None:
+                snapshots.take(stream.index, is_first_arg, result)
+            raw = arg = stream.next()
+            if type(raw) is bytes:
+                arg = os.fsdecode(raw)
+            if instr is not None:
+                instr._token(self, arg, is_first_arg)
+            target = dispatch.get(arg)
+
+            if type(target) is Flag:
+                result._counts[target] = result._counts.get(target, 0) + 1
+
+            elif target is not None and stream.has_next():
+                self._append_value(target, stream.next(), result)
+
+            elif arg == "--":
+                self._handle_separator(stream, result)
+
+            elif arg.startswith("--"):
+                if "=" in arg:
+                    self._handle_equals_opt(arg[2:], result, raw is not arg)
+                else:
+                    self._handle_long_opt(arg[2:], stream, result)
+
+            elif arg.startswith("-"):
+                if arg == '-' or arg[1].isdigit():
+                    result.args.append(raw)
+                elif "=" in arg:
+                    self._handle_equals_opt(arg[1:], result, raw is not arg)
+                else:
+                    self._handle_short_opt(arg[1:], stream, result)
+
+            elif is_first_arg and (name := self._expand_command(arg)) in self.commands:
+                self._handle_command(name, stream, result)
+
+            elif is_first_arg and enable_help_command and name == "help":
+                self._handle_help_command(stream)
+
+            else:
+                result.args.append(raw)
+
+            is_first_arg = False
+
+    # Consume the arguments following a '--' switch as positional arguments.
+    def _handle_separator(self, stream, result):
+        if result.args:
+            result.args.extend(stream.rest())
+        else:
+            result.args = stream.rest()
+
+    # Parse the remaining arguments into a result for the command `name`, then call or defer
+    # the command's callback.
+    def _handle_command(self, name, stream, result):
+        cmd_parser = self.commands[name]
+        instr = result._instr
+        result.command_name = name
+        result.command_parser = ParseResult(cmd_parser, result._pending, instr, result._snapshots)
+        if instr is not None:
+            instr._emit("command", name)
+        self._finish(result)
+        cmd_parser._parse_stream(stream, result.command_parser)
+        if cmd_parser.callback:
+            if result._pending is None and instr is not None:
+                start = time.perf_counter()
+                cmd_parser.callback(name, result.command_parser)
+                duration = time.perf_counter() - start
+                instr._add_time("callbacks", duration)
+                instr._emit("callback", name, duration)
+            elif result._pending is None:
+                cmd_parser.callback(name, result.command_parser)
+            else:
+                result._pending.append((cmd_parser.callback, name, result.command_parser))
+
+    # Handle the automatic 'help' command by printing the named command's help text.
+    def _handle_help_command(self, stream):
+        if stream.has_next():
+            name = stream.next()
+            if type(name) is bytes:
+                name = os.fsdecode(name)
+            name = self._expand_command(name)
+            if name in self.commands:
+                self.commands[name].exit_help()
+            else:
+                self.exit_error(f"'{name}' is not a recognised command{self._suggest(name, True)}")
+        else:
+            self.exit_error("missing argument for the help command")
+
+    # Convert the parser's batch options and check its constraints once its own arguments have
+    # been parsed, i.e. at the end of the stream or before parsing a command's arguments.
+    def _finish(self, result):
+        if self._batches:
+            self._convert_batches(result)
+        if self._constraints is not None:
+            self._check_constraints(result)
+
+    # Parse an argument of the form --name=value or -n=value. If `as_bytes` is true the
+    # argument was decoded from bytes and the value is re-encoded.
+    def _handle_equals_opt(self, arg, result, as_bytes=False):
         name, value = arg.split("=", maxsplit=1)
-        if option := self.options.get(name):
-            if not option.try_append_value(value):
-                self.exit_error(f"invalid option value '{value}'")
+        if as_bytes:
+            value = os.fsencode(value)
+        option = self.options.get(name)
+        if option is None and self.enable_abbreviations:
+            if full_name := self._expand_option(name):
+                option = self.options.get(full_name)
+        if option is not None:
+            self._append_value(option, value, result)
         else:
-            self.exit_error(f"'{name}' is not a recognised option name")
+            self.exit_error(f"'{name}' is not a recognised option name{self._suggest(name)}")
 
     # Parse a long-form option, i.e. an option beginning with a double dash.
-    def _handle_long_opt(self, arg, stream):
+    def _handle_long_opt(self, arg, stream, result):
         if flag := self.flags.get(arg):
-            flag.count += 1
+            counts = result._counts
+            counts[flag] = counts.get(flag, 0) + 1
         elif option := self.options.get(arg):
-            if stream.has_next():
+            if not stream.has_next():
+                self.exit_error(f"missing argument for --{arg} option")
+            elif result._instr is None:
                 value = stream.next()
-                if not option.try_append_value(value):
+                if not option.try_append_value(result._values.setdefault(option, []), value):
                     self.exit_error(f"invalid option value '{value}'")
             else:
-                self.exit_error(f"missing argument for --{arg} option")
+                self._append_value(option, stream.next(), result)
         elif arg == "help" and self.helptext is not None:
             self.exit_help()
         elif arg == "version" and self.version is not None:
             self.exit_version()
+        elif self.enable_abbreviations and (full_name := self._expand_option(arg)):
+            self._handle_long_opt(full_name, stream, result)
+        else:
+            self.exit_error(f"--{arg} is not a recognised flag or option name{self._suggest(arg)}")
+
+    # Returns the full name of a flag or option given a unique prefix, or None if the name isn't
+    # a prefix of any registered name. Exits with an error if the prefix is ambiguous.
+    def _expand_option(self, name):
+        full_name, candidates = self._index(_PrefixTrie).resolve(name)
+        if candidates:
+            names = ", ".join(f"--{candidate}" for candidate in candidates)
+            self.exit_error(f"--{name} is ambiguous, could be {names}")
+        return full_name
+
+    # Returns the full name of a command given a unique prefix if abbreviations are enabled,
+    # otherwise the name itself. Exits with an error if the prefix is ambiguous.
+    def _expand_command(self, name):
+        if not self.enable_abbreviations or name in self.commands:
+            return name
+        full_name, candidates = self._index(_PrefixTrie, commands=True).resolve(name)
+        if candidates:
+            self.exit_error(f"'{name}' is ambiguous, could be {', '.join(candidates)}")
+        return full_name or name
+
+    # Returns an index of type `cls` over the parser's flag and option names, or its command
+    # names, building it on demand. Indexes are discarded when new names are registered.
+    # Names map to the Flag, Option, or ArgParser instance they identify; the automatic help
+    # and version flags and the help command map to the strings 'help' and 'version'.
+    def _index(self, cls, commands=False):
+        if (index := self._indexes.get((cls, commands))) is not None:
+            return index
+        if commands:
+            names = dict(self.commands)
+            if self.enable_help_command or self.help_command:
+                names.setdefault("help", "help")
         else:
-            self.exit_error(f"--{arg} is not a recognised flag or option name")
+            names = dict(self.options)
+            names.update(self.flags)
+            if self.helptext is not None:
+                names.setdefault("help", "help")
+            if self.version is not None:
+                names.setdefault("version", "version")
+        index = self._indexes[(cls, commands)] = cls(names)
+        return index
+
+    # Returns the namespace class generated from the parser's flags and options and a list of
+    # (slot, target) pairs for filling its slots, building them on first use.
+    def _namespace_spec(self):
+        if (spec := self._indexes.get(Namespace)) is not None:
+            return spec
+        import keyword
+        fields = {}
+        for target in itertools.chain(
+            dict.fromkeys(self.flags.values()), dict.fromkeys(self.options.values())
+        ):
+            slot = target.name.replace("-", "_")
+            if slot.isidentifier() and not keyword.iskeyword(slot):
+                fields.setdefault(slot, target)
+        for slot in ("args", "command_name", "command"):
+            fields.pop(slot, None)
+        slots = (*fields, "args", "command_name", "command")
+        cls = type("Namespace", (Namespace,), {"__slots__": slots})
+        spec = self._indexes[Namespace] = (cls, list(fields.items()))
+        return spec
+
+    # Returns a " (did you mean ...?)" suffix for an error message listing the registered names
+    # closest to an unrecognised name, or an empty string if there are none.
+    def _suggest(self, name, commands=False):
+        if self.max_suggestions <= 0:
+            return ""
+        names = self._index(_BKTree, commands).search(name, self.suggestion_distance, self.max_suggestions)
+        if not names:
+            return ""
+        if not commands:
+            names = [_token(name) for name in names]
+        return f" (did you mean {' or '.join(names)}?)"
 
     # Parse a short-form option, i.e. an option beginning with a single dash.
-    def _handle_short_opt(self, arg, stream):
+    def _handle_short_opt(self, arg, stream, result):
         for char in arg:
             if flag := self.flags.get(char):
-                flag.count += 1
+                counts = result._counts
+                counts[flag] = counts.get(flag, 0) + 1
             elif option := self.options.get(char):
-                if stream.has_next():
+                if stream.has_next() and result._instr is None:
                     value = stream.next()
-                    if not option.try_append_value(value):
+                    if not option.try_append_value(result._values.setdefault(option, []), value):
                         self.exit_error(f"invalid option value '{value}'")
+                elif stream.has_next():
+                    self._append_value(option, stream.next(), result)
                 elif len(arg) > 1:
                     self.exit_error(f"missing argument for '{char}' option in -{arg}")
                 else:
@@ -221,9 +833,53 @@ class ArgParser:
             elif char == "v" and self.version is not None:
                 self.exit_version()
             elif len(arg) > 1:
-                self.exit_error(f"'{char}' in -{arg} is not a recognised flag or option name")
+                self.exit_error(
+                    f"'{char}' in -{arg} is not a recognised flag or option name{self._suggest(arg)}"
+                )
             else:
-                self.exit_error(f"-{arg} is not a recognised flag or option name")
+                self.exit_error(f"-{arg} is not a recognised flag or option name{self._suggest(arg)}")
+
+    # Load the config file values for the keys of the parser's registered options, exiting with
+    # an error if the file can't be parsed.
+    def _load_config(self):
+        keys = tuple(sorted({opt.config for opt in self.options.values() if opt.config}))
+        if not keys:
+            return {}
+        try:
+            return _read_config_file(self.config_file, keys, self.config_cache_dir)
+        except ArgsError as err:
+            self.exit_error(str(err))
+
+    # Convert the raw values collected for the parser's batch options, exiting with an error
+    # identifying the first invalid value if a batch can't be converted.
+    def _convert_batches(self, result):
+        for option in self._batches:
+            if str_vals := result._values.get(option):
+                start = time.perf_counter()
+                try:
+                    result._values[option] = option.type(str_vals)
+                    if result._snapshots is not None:
+                        result._snapshots.raw[(result, option)] = str_vals
+                except:
+                    for str_val in str_vals:
+                        try:
+                            option.type([str_val])
+                        except:
+                            self.exit_error(f"invalid option value '{str_val}'")
+                    self.exit_error(f"invalid values for option '{option.name}'")
+                if result._instr is not None:
+                    result._instr._converted(option, str_vals, time.perf_counter() - start)
+
+    # Convert an option value and append it to the result's list of values for the option.
+    def _append_value(self, option, value, result):
+        if result._instr is None or option.lazy:
+            if not option.try_append_value(result._values.setdefault(option, []), value):
+                self.exit_error(f"invalid option value '{value}'")
+        else:
+            start = time.perf_counter()
+            if not option.try_append_value(result._values.setdefault(option, []), value):
+                self.exit_error(f"invalid option value '{value}'")
+            result._instr._converted(option, value, time.perf_counter() - start)
 
     # ---------------- #
     # Utility methods. #
@@ -231,51 +887,115 @@ class ArgParser:
 
     # Print the parser's state for debugging.
     def __str__(self):
-        lines = []
-
-        lines.append("Flags:")
-        if self.flags:
-            for name, flag in sorted(self.flags.items()):
-                lines.append(f"  {name}: {flag.count}")
-        else:
-            lines.append("  [none]")
+        return str(self._last_result())
+
+    # Run each line of a script through the parser. The `file` argument can be a path or a text
+    # file object and defaults to stdin. Lines are split into arguments using shell quoting
+    # rules; blank lines and comments are skipped. Each line is parsed into a fresh result,
+    # calling any command callbacks, then calls `main` with the ParseResult if specified. A
+    # SystemExit raised while running a line, e.g. by exit_error(), only ends that line. Returns
+    # a list of exit statuses, one for each line run.
+    def run_script(self, file=None, main=None):
+        import shlex
+        if file is None:
+            file = sys.stdin
+        elif isinstance(file, (str, os.PathLike)):
+            with open(file) as file:
+                return self.run_script(file, main)
+
+        statuses = []
+        for line in file:
+            try:
+                args = shlex.split(line, comments=True)
+            except ValueError as err:
+                print(f"Error: {str(err).lower()}.", file=sys.stderr)
+                statuses.append(1)
+                continue
+            if not args:
+                continue
+            try:
+                result = self.parse(args)
+                if main is not None:
+                    main(result)
+            except SystemExit as err:
+                statuses.append(_exit_status(err))
+            else:
+                statuses.append(0)
+        return statuses
+
+    # Run a resident server which listens for requests from run_client() on a Unix socket at
+    # `path`. The server forks a new process for each request, which parses the client's
+    # arguments in the client's working directory and environment with the client's stdin,
+    # stdout, and stderr, calls any command callbacks, then calls `main` with the ParseResult
+    # if specified. The client exits with the request's exit status. Runs until interrupted.
+    # A stale socket at `path` is replaced; raises an ArgsError if anything else exists there.
+    # The socket is only accessible to its owner.
+    def serve(self, path, main=None):
+        import signal
+        import socket
+        import stat
 
-        lines.append("\nOptions:")
-        if self.options:
-            for name, opt in sorted(self.options.items()):
-                lines.append(f"  {name}: ({opt.default}) {opt.values}")
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
         else:
-            lines.append("  [none]")
+            if not stat.S_ISSOCK(mode):
+                raise ArgsError(f"'{path}' exists and is not a socket")
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen()
 
-        lines.append("\nArguments:")
-        if self.args:
-            for arg in self.args:
-                lines.append(f"  {arg}")
-        else:
-            lines.append("  [none]")
+        # Supervisor processes exit independently so the kernel can reap them.
+        sigchld_handler = signal.signal(signal.SIGCHLD, signal.SIG_IGN)
 
-        lines.append("\nCommand:")
-        if self.command_name:
-            lines.append(f"  {self.command_name}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                _flush_stdio()
+                if os.fork() == 0:
+                    server.close()
+                    _supervise_request(self, main, conn)
+                conn.close()
+        finally:
+            server.close()
+            os.unlink(path)
+            signal.signal(signal.SIGCHLD, sigchld_handler)
+
+    # Returns a self-contained shell completion script for the parser and its commands.
+    # The `shell` argument can be "bash", "zsh", or "fish". The `prog` argument specifies
+    # the application name, defaulting to the name of the running script.
+    def completion_script(self, shell, prog=None):
+        prog = prog or os.path.basename(sys.argv[0])
+        levels = list(_completion_levels(self))
+        if shell == "bash":
+            return _bash_completion(prog, levels)
+        elif shell == "zsh":
+            return "autoload -U +X bashcompinit && bashcompinit\n\n" + _bash_completion(prog, levels)
+        elif shell == "fish":
+            return _fish_completion(prog, levels)
         else:
-            lines.append("  [none]")
-
-        return "\n".join(lines)
+            raise ArgsError(f"'{shell}' is not a supported shell")
 
     # Python doesn't make this easy... By default when we ask for the command line arguments
     # it hands us a list of booby-trapped "strings" which might explode when we try to use them
     # because they contain invalid unicode characters smuggled in as "surrogateescapes". This
     # method filters sys.argv and either returns a list of valid Python strings or raises
     # an ArgsError exception.
+    #
+    # ASCII arguments can't contain surrogateescapes so they're returned without re-encoding.
+    # In bytes mode the arguments are returned as their original bytes. The arguments are
+    # returned as a tuple so arguments following a '--' switch can be taken as a view.
     def _get_argstrings(self):
-        args_as_strs = []
+        if self.bytes_mode:
+            return tuple([os.fsencode(arg) for arg in sys.argv[1:]])
         fsencoding = sys.getfilesystemencoding()
-        for arg_as_bytes in (os.fsencode(arg) for arg in sys.argv[1:]):
-            try:
-                args_as_strs.append(arg_as_bytes.decode(encoding=fsencoding))
-            except UnicodeError as err:
-                raise InvalidUnicode("argument is not a valid unicode string") from err
-        return args_as_strs
+        return tuple([
+            arg if arg.isascii() else _decode_arg(os.fsencode(arg), fsencoding)
+            for arg in sys.argv[1:]
+        ])
 
     # ------------- #
     # Exit helpers. #
@@ -283,7 +1003,9 @@ class ArgParser:
 
     # Print the parser's help text and exit.
     def exit_help(self):
-        print(self.helptext.strip() if self.helptext else "")
+        self._load()
+        helptext = self.helptext(self) if callable(self.helptext) else self.helptext
+        print(helptext.strip() if helptext else "")
         sys.exit()
 
     # Print the parser's version string and exit.
@@ -296,46 +1018,1842 @@ class ArgParser:
         sys.exit(f"Error: {msg}.")
 
 
+# An IncrementalParser instance re-parses an argument list which changes a little between calls,
+# e.g. the tokens of a command line as they're typed. The parser state is snapshotted at each
+# token boundary; each call resumes from the latest snapshot preceding the first changed token,
+# so appending a token only costs parsing the last few tokens. The result is identical to the
+# result of a full parse except that command callbacks are not called. The chain of results is
+# reused between calls, so a result is only valid until the next call.
+class IncrementalParser:
+
+    def __init__(self, parser):
+        self.parser = parser
+        self._args = []
+        self._log = _SnapshotLog()
+        self._result = None
+
+    # Parse a list of string arguments. Returns the updated ParseResult instance.
+    def parse(self, args):
+        parser = self.parser
+        args = list(args)
+        if parser.enable_response_files:
+            args = list(_expand_response_files(args, parser.cache_response_files))
+
+        prefix = 0
+        for old_arg, new_arg in zip(self._args, args):
+            if old_arg != new_arg:
+                break
+            prefix += 1
+        log = self._log
+        while log.snapshots and log.snapshots[-1].index > prefix:
+            log.snapshots.pop()
+        self._args = args
+
+        instr = parser.instrumentation or _env_instrumentation()
+        if log.snapshots:
+            snapshot = log.snapshots[-1]
+            result = self._result
+            result._pending.clear()
+            active = snapshot.restore(log.raw)
+            start, is_first_arg = snapshot.index, snapshot.is_first_arg
+        else:
+            log.raw.clear()
+            result = active = self._result = ParseResult(parser, [], instr, log)
+            start, is_first_arg = 0, True
+
+        if instr is None:
+            active.parser._parse_stream(_arg_stream(args, start), active, is_first_arg)
+        else:
+            start_time = time.perf_counter()
+            active.parser._parse_stream(_arg_stream(args, start), active, is_first_arg)
+            instr._add_time("parse", time.perf_counter() - start_time)
+        result._bind()
+        return result
+
+
+# Internal class for recording an IncrementalParser's snapshots while parsing. The raw values of
+# batch options are kept here when they're converted so they can be restored.
+class _SnapshotLog:
+
+    __slots__ = ("snapshots", "raw")
+
+    def __init__(self):
+        self.snapshots = []
+        self.raw = {}
+
+    # Record a snapshot of the result being parsed into after the first `index` arguments have
+    # been parsed, unless there's already a snapshot at the same index.
+    def take(self, index, is_first_arg, result):
+        if self.snapshots and self.snapshots[-1].index >= index:
+            return
+        self.snapshots.append(_Snapshot(index, is_first_arg, result))
+
+
+# Internal class for storing the state of the result being parsed into at a token boundary.
+# Between boundaries the result's positional arguments and option values are only appended to,
+# so the snapshot stores their lengths rather than copies. Results for parent commands don't
+# change after their command is found, so they don't need to be stored.
+class _Snapshot:
+
+    __slots__ = ("index", "is_first_arg", "result", "counts", "lengths", "num_args")
+
+    def __init__(self, index, is_first_arg, result):
+        self.index = index
+        self.is_first_arg = is_first_arg
+        self.result = result
+        self.counts = dict(result._counts)
+        self.lengths = {option: len(values) for option, values in result._values.items()}
+        self.num_args = len(result.args)
+
+    # Truncate the result to its state at the snapshot and return it. Batch option values
+    # converted since the snapshot are replaced by their raw values from `raw`.
+    def restore(self, raw):
+        result = self.result
+        result._counts.clear()
+        result._counts.update(self.counts)
+        values = {}
+        for option, option_values in result._values.items():
+            option_values = raw.pop((result, option), option_values)
+            if (length := self.lengths.get(option)) is not None:
+                del option_values[length:]
+                values[option] = option_values
+        result._values = values
+        del result.args[self.num_args:]
+        result.command_name = None
+        result.command_parser = None
+        return result
+
+
+# Returns a list of copies of the state of each result in a chain of results.
+def _snapshot_levels(result):
+    levels = []
+    while result is not None:
+        levels.append((
+            result.parser,
+            dict(result._counts),
+            {option: values[:] for option, values in result._values.items()},
+            result.args[:],
+            result.command_name,
+        ))
+        result = result.command_parser
+    return levels
+
+
+# Internal class for storing a ParseCache outcome as copies of the state of a chain of results.
+class _CachedOutcome:
+
+    __slots__ = ("levels",)
+
+    def __init__(self, levels):
+        self.levels = levels
+
+    # Returns a new chain of results restored from the cached outcome.
+    def restore(self, instr):
+        root = parent = None
+        for parser, counts, values, args, command_name in self.levels:
+            result = ParseResult(parser, [], instr)
+            result._counts = dict(counts)
+            result._values = {option: option_values[:] for option, option_values in values.items()}
+            result.args = args[:]
+            result.command_name = command_name
+            if parent is None:
+                root = result
+            else:
+                parent.command_parser = result
+            parent = result
+        return root
+
+
+# A ParseCache instance is a bounded LRU cache of parse outcomes keyed by argument list. Assign
+# an instance to a parser's parse_cache attribute to enable caching. Each call to parse() with
+# a cached argument list returns a fresh ParseResult restored from the cached outcome without
+# reparsing the arguments or calling option converters again; command callbacks are still
+# called. The cache is safe to share between threads. Cached outcomes are discarded whenever a
+# flag, option, command, or constraint is registered on the parser or one of its commands.
+class ParseCache:
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Remove all cached outcomes. The counters are not reset.
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Discard the cached outcomes if they were cached for a different spec `generation`. Must be
+    # called with the lock held.
+    def _check_generation(self, generation):
+        if self._generation != generation:
+            self._entries.clear()
+            self._generation = generation
+
+    def _get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            snapshot = self._entries.get(key)
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return snapshot
+
+    def _put(self, key, snapshot, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = snapshot
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+# Internal class for storing the spec generation shared by a parser and its command parsers,
+# incremented whenever a flag, option, command, or constraint is registered.
+class _ParserTree:
+
+    __slots__ = ("generation",)
+
+    def __init__(self):
+        self.generation = 0
+
+
+# Returns true if a converted option value can't be modified, i.e. can be shared between results
+# restored from a cached outcome.
+def _is_immutable(value):
+    if type(value) in (str, bytes, int, float, complex, bool, _Unconverted) or value is None:
+        return True
+    if type(value) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+# Decorator marking an option converter as impure, i.e. as returning different values for the
+# same string. Parses which convert a value with an impure converter are never cached.
+def impure(converter):
+    converter.argslib_impure = True
+    return converter
+
+
+# Returns true if an option type is an impure converter or a batch converter wrapping one.
+def _is_impure(converter):
+    if getattr(converter, "argslib_impure", False):
+        return True
+    return type(converter) is Batch and getattr(converter.func, "argslib_impure", False)
+
+
+# Base class for the namespace classes generated by ParseResult.namespace(). Each generated class
+# has a slot for each of a parser's flags and options, named after the flag or option's first
+# alias with dashes replaced by underscores.
+class Namespace:
+
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in self.__slots__)
+        return f"Namespace({fields})"
+
+
+# Internal class for storing a parser's compiled constraints. Each constrained flag or option is
+# assigned a bit; the required, exclusive, and requires constraints are stored as bitmasks.
+class _Constraints:
+
+    __slots__ = ("bits", "required", "exclusive", "requires", "limits", "async_limits")
+
+    def __init__(self):
+        self.bits = {}
+        self.required = 0
+        self.exclusive = []
+        self.requires = []
+        self.limits = []
+        self.async_limits = []
+
+    # Returns the command line tokens for the flags and options in a bitmask.
+    def names(self, mask):
+        return [_token(target.name) for target, bit in self.bits.items() if bit & mask]
+
+
+# Serializes calls to command loaders so a parser shared between threads is only loaded once.
+_loader_lock = threading.RLock()
+
+
+# A ParseResult instance stores the flags, options, arguments, and command found by a single
+# call to ArgParser.parse(). It supports the same inspection API as the parser itself.
+# Attributes not defined here, e.g. helptext or exit_help(), are looked up on the parser.
+class ParseResult:
+
+    __slots__ = (
+        "parser", "_pending", "_instr", "_snapshots", "_counts", "_values", "_config", "args",
+        "command_name", "command_parser",
+    )
+
+    def __init__(self, parser, pending=None, instr=None, snapshots=None):
+
+        # The ArgParser instance whose specification produced this result.
+        self.parser = parser
+
+        # If not None, command callbacks are appended to this list instead of being called.
+        self._pending = pending
+
+        # Stores an Instrumentation instance if parsing is being instrumented.
+        self._instr = instr
+
+        # Stores a _SnapshotLog instance if parsing is being run by an IncrementalParser.
+        self._snapshots = snapshots
+
+        # Stores flag counts indexed by Flag instance. Instrumented results emit an event for
+        # each update.
+        self._counts = {} if instr is None else _InstrumentedCounts(instr)
+
+        # Stores lists of option values indexed by Option instance.
+        self._values = {}
+
+        # Stores the parser's config file values, loaded on first use.
+        self._config = None
+
+        # Stores positional arguments parsed from the input stream. Arguments following a '--'
+        # switch may be stored as an ArgsView over the input tuple rather than copied.
+        self.args = []
+
+        # Stores the command name, if a command was found.
+        self.command_name = None
+
+        # Stores the command's ParseResult, if a command was found.
+        self.command_parser = None
+
+    def __getattr__(self, name):
+        if name == "parser":
+            raise AttributeError(name)
+        return getattr(self.parser, name)
+
+    # Returns the number of times the specified flag or option has been found.
+    def count(self, name):
+        if flag := self.parser.flags.get(name):
+            return self._counts.get(flag, 0)
+        elif option := self.parser.options.get(name):
+            return len(self._values.get(option, ()))
+        else:
+            raise InvalidName(f"'{name}' is not a recognised flag or option name")
+
+    # Returns true if the specified flag or option was found.
+    def found(self, name):
+        return self.count(name) > 0
+
+    # Returns the value of the specified option.
+    def value(self, name):
+        if option := self.parser.options.get(name):
+            return self._option_value(option)
+        else:
+            raise InvalidName(f"'{name}' is not a recognised option name")
+
+    # Returns the specified option's list of values.
+    def values(self, name):
+        if option := self.parser.options.get(name):
+            return self._option_values(option)
+        else:
+            raise InvalidName(f"'{name}' is not a recognised option name")
+
+    # Returns the result as an instance of a namespace class generated from the parser's spec,
+    # with an attribute for each flag's count and each option's value, plus `args`,
+    # `command_name`, and `command`, a nested namespace for the command's result, if any. The
+    # namespace class is cached by the parser so repeated calls only fill its slots.
+    def namespace(self):
+        self.parser._load()
+        cls, fields = self.parser._namespace_spec()
+        namespace = cls()
+        for slot, target in fields:
+            if type(target) is Flag:
+                setattr(namespace, slot, self._counts.get(target, 0))
+            else:
+                setattr(namespace, slot, self._option_value(target))
+        namespace.args = self.args
+        namespace.command_name = self.command_name
+        if self.command_parser is not None:
+            namespace.command = self.command_parser.namespace()
+        else:
+            namespace.command = None
+        return namespace
+
+    # Convert the values of all lazy options, here and in any command result, so that invalid
+    # values are reported immediately. Returns the result to allow chaining.
+    def validate(self):
+        for option in self._values:
+            self._option_values(option)
+        if self.command_parser is not None:
+            self.command_parser.validate()
+        return self
+
+    # Await the values of all options with async converters, here and in any command result.
+    async def _convert_async(self):
+        for option, values in self._values.items():
+            if inspect.iscoroutinefunction(option.type):
+                for i, value in enumerate(values):
+                    if type(value) is _Unconverted:
+                        try:
+                            values[i] = await option.type(value.str_val)
+                        except:
+                            self.parser.exit_error(f"invalid option value '{value.str_val}'")
+        constraints = self.parser._constraints
+        if constraints is not None and constraints.async_limits:
+            if errors := self.parser._limit_errors(self, constraints.async_limits):
+                self.parser.exit_error("; ".join(errors))
+        if self.command_parser is not None:
+            await self.command_parser._convert_async()
+
+    # Returns true if any option value in the chain of results was converted by a converter
+    # marked as impure.
+    def _impure(self):
+        result = self
+        while result is not None:
+            for option in result._values:
+                if _is_impure(option.type):
+                    return True
+            result = result.command_parser
+        return False
+
+    # Returns true if every converted option value in the chain of results is immutable. Value
+    # lists and arrays are copied when an outcome is restored from the cache but their items
+    # are shared.
+    def _immutable(self):
+        result = self
+        while result is not None:
+            for values in result._values.values():
+                if type(values) is array.array:
+                    continue
+                if type(values) is not list or not all(map(_is_immutable, values)):
+                    return False
+            result = result.command_parser
+        return True
+
+    # Bind the result to the chain of matched parsers for the legacy inspection API.
+    def _bind(self):
+        bound = self
+        while bound is not None:
+            bound.parser._result = bound
+            bound = bound.command_parser
+
+    # Returns the value of the specified Option instance, converting it if required.
+    def _option_value(self, option):
+        if values := self._values.get(option):
+            if type(values[-1]) is _Unconverted:
+                values[-1] = self._convert(option, values[-1].str_val)
+            return values[-1]
+        if option.env is None and option.config is None:
+            return option.default
+        return self._fallback(option)
+
+    # Returns the value of an option which wasn't found: the value of its environment variable,
+    # then the value of its config file key, then its default value.
+    def _fallback(self, option):
+        if option.env is not None and (str_val := os.environ.get(option.env)) is not None:
+            return self._convert(option, str_val)
+        if option.config is not None and self.parser.config_file is not None:
+            if self._config is None:
+                self._config = self.parser._load_config()
+            if option.config in self._config:
+                value = self._config[option.config]
+                if type(value) in (list, dict):
+                    value = copy.deepcopy(value)
+                return self._convert(option, value)
+        return option.default
+
+    # Returns the list of values of the specified Option instance, converting them if required.
+    def _option_values(self, option):
+        values = self._values.setdefault(option, [])
+        if option.lazy:
+            for i, value in enumerate(values):
+                if type(value) is _Unconverted:
+                    values[i] = self._convert(option, value.str_val)
+        return values
+
+    # Convert a lazy option's raw string value, exiting with an error if the value is invalid.
+    # Raises an ArgsError if the option's converter is async as its values can only be
+    # converted by parse_async().
+    def _convert(self, option, str_val):
+        if inspect.iscoroutinefunction(option.type):
+            raise ArgsError(
+                f"{_token(option.name)} has an async converter; its values are only converted "
+                "by parse_async()"
+            )
+        start = time.perf_counter()
+        try:
+            value = option.convert(str_val)
+        except:
+            self.parser.exit_error(f"invalid option value '{str_val}'")
+        if self._instr is not None:
+            self._instr._converted(option, str_val, time.perf_counter() - start)
+        return value
+
+    # Print the result for debugging.
+    def __str__(self):
+        lines = []
+
+        lines.append("Flags:")
+        if self.parser.flags:
+            for name, flag in sorted(self.parser.flags.items()):
+                lines.append(f"  {name}: {self._counts.get(flag, 0)}")
+        else:
+            lines.append("  [none]")
+
+        lines.append("\nOptions:")
+        if self.parser.options:
+            for name, opt in sorted(self.parser.options.items()):
+                lines.append(f"  {name}: ({opt.default}) {self._option_values(opt)}")
+        else:
+            lines.append("  [none]")
+
+        lines.append("\nArguments:")
+        if self.args:
+            for arg in self.args:
+                lines.append(f"  {arg}")
+        else:
+            lines.append("  [none]")
+
+        lines.append("\nCommand:")
+        if self.command_name:
+            lines.append(f"  {self.command_name}")
+        else:
+            lines.append("  [none]")
+
+        return "\n".join(lines)
+
+
+# A ParseColumns instance stores the results of a call to ArgParser.parse_many() in columnar
+# form, with one row per argument list. Only the flags, options, and commands registered
+# directly on the parser are recorded.
+class ParseColumns:
+
+    # Values stored in the status column.
+    OK = 0
+    ERROR = 1
+    EXIT = 2
+
+    def __init__(self, parser):
+
+        # The ArgParser instance whose specification produced these results.
+        self.parser = parser
+        parser._load()
+
+        # The number of rows.
+        self.size = 0
+
+        # Stores OK, ERROR, or EXIT (for --help and --version) for each row. Rows with a
+        # status other than OK have no flags, options, arguments, or command.
+        self.status = array.array("B")
+
+        # Stores positional arguments for all rows. The arguments for row i are stored
+        # in the slice args[offsets[i]:offsets[i+1]].
+        self.args = []
+        self.offsets = array.array("Q", [0])
+
+        # Stores an index into command_names for each row, or -1 if no command was found.
+        self.command_ids = array.array("l")
+        self.command_names = []
+        self._command_ids = {}
+
+        # Flags and options are numbered in registration order.
+        self._flags = {flag: i for i, flag in enumerate(dict.fromkeys(parser.flags.values()))}
+        self._options = {opt: i for i, opt in enumerate(dict.fromkeys(parser.options.values()))}
+        self._flag_counts = [array.array("L") for _ in self._flags]
+        self._option_counts = [array.array("L") for _ in self._options]
+        self._option_values = [[] for _ in self._options]
+
+    # Returns an array of the number of times the specified flag or option was found in each row.
+    def count(self, name):
+        if flag := self.parser.flags.get(name):
+            return self._flag_counts[self._flags[flag]]
+        elif option := self.parser.options.get(name):
+            return self._option_counts[self._options[option]]
+        else:
+            raise InvalidName(f"'{name}' is not a recognised flag or option name")
+
+    # Returns a list of the specified option's value in each row.
+    def value(self, name):
+        if option := self.parser.options.get(name):
+            return self._option_values[self._options[option]]
+        else:
+            raise InvalidName(f"'{name}' is not a recognised option name")
+
+    # Returns the list of positional arguments for the specified row.
+    def args_for(self, row):
+        return self.args[self.offsets[row]:self.offsets[row + 1]]
+
+    # Returns the command name for the specified row, or None if no command was found.
+    def command_for(self, row):
+        command_id = self.command_ids[row]
+        return self.command_names[command_id] if command_id >= 0 else None
+
+    # Append a row. The result should be None if the status is not OK.
+    def _append(self, result, status):
+        self.size += 1
+        self.status.append(status)
+        counts = result._counts if result else {}
+        values = result._values if result else {}
+        for flag, i in self._flags.items():
+            self._flag_counts[i].append(counts.get(flag, 0))
+        for option, i in self._options.items():
+            option_values = values.get(option)
+            self._option_counts[i].append(len(option_values) if option_values else 0)
+            self._option_values[i].append(result._option_value(option) if result else option.default)
+        if result:
+            self.args.extend(result.args)
+        self.offsets.append(len(self.args))
+        if result and result.command_name is not None:
+            self.command_ids.append(self._command_id(result.command_name))
+        else:
+            self.command_ids.append(-1)
+
+    # Append the rows from another ParseColumns instance with the same specification.
+    def _extend(self, other):
+        self.size += other.size
+        self.status.extend(other.status)
+        for i in range(len(self._flag_counts)):
+            self._flag_counts[i].extend(other._flag_counts[i])
+        for i in range(len(self._option_counts)):
+            self._option_counts[i].extend(other._option_counts[i])
+            self._option_values[i].extend(other._option_values[i])
+        base = len(self.args)
+        self.args.extend(other.args)
+        self.offsets.extend(base + offset for offset in other.offsets[1:])
+        remapped = [self._command_id(name) for name in other.command_names]
+        self.command_ids.extend(remapped[i] if i >= 0 else -1 for i in other.command_ids)
+
+    # Returns the instance's columns for sending from a parse_many() worker process. The parser
+    # and the Flag and Option indexes are left out as the parent process already has them.
+    def _worker_state(self):
+        state = vars(self).copy()
+        del state["parser"], state["_flags"], state["_options"]
+        return state
+
+    # Returns an instance restored from a worker's state. It can only be passed to _extend().
+    @staticmethod
+    def _from_worker_state(state):
+        columns = ParseColumns.__new__(ParseColumns)
+        vars(columns).update(state)
+        return columns
+
+    # Returns the index of the specified command name in command_names, adding it if required.
+    def _command_id(self, name):
+        if (command_id := self._command_ids.get(name)) is None:
+            command_id = self._command_ids[name] = len(self.command_names)
+            self.command_names.append(name)
+        return command_id
+
+
+# Stores the parser used by a parse_many() worker process.
+_worker_parser = None
+
+
+# Initialize a parse_many() worker process. The parser is sent to each worker only once.
+def _init_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+# Parse a chunk of argument lists in a parse_many() worker process, returning the state of the
+# ParseColumns instance to send back to the parent process.
+def _parse_worker_chunk(argvs):
+    return _parse_chunk(_worker_parser, argvs)._worker_state()
+
+
+# Parse a chunk of argument lists for ArgParser.parse_many(), returning a ParseColumns instance.
+def _parse_chunk(parser, argvs):
+    columns = ParseColumns(parser)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for argv in argvs:
+            result = ParseResult(parser, [])
+            try:
+                parser._parse_stream(_arg_stream(argv), result)
+                result.validate()
+            except SystemExit as err:
+                status = ParseColumns.EXIT if err.code is None else ParseColumns.ERROR
+                columns._append(None, status)
+            else:
+                columns._append(result, ParseColumns.OK)
+    return columns
+
+
+# Connect to a server started by ArgParser.serve() listening on the Unix socket at `path` and run
+# a request for `argv`, defaulting to the application's command line arguments. The server uses
+# this process's working directory, environment, stdin, stdout, and stderr. Signals received
+# while the request is running are forwarded to the server. Returns the request's exit status.
+def run_client(path, argv=None):
+    import json
+    import signal
+    import socket
+    import struct
+
+    request = json.dumps({
+        "argv": sys.argv if argv is None else [sys.argv[0]] + list(argv),
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+    }).encode()
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    socket.send_fds(conn, [struct.pack("!I", len(request))], [0, 1, 2])
+    conn.sendall(request)
+
+    def forward(signum, frame):
+        conn.sendall(struct.pack("!i", signum))
+
+    forwarded = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT)
+    handlers = {signum: signal.signal(signum, forward) for signum in forwarded}
+    try:
+        reply = _recv_exactly(conn, 4)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        conn.close()
+
+    if len(reply) < 4:
+        return 1
+    status = struct.unpack("!i", reply)[0]
+    if status < 0:
+        signal.signal(-status, signal.SIG_DFL)
+        os.kill(os.getpid(), -status)
+        return 128 - status
+    return status
+
+
+# Handle a single request in a process forked by ArgParser.serve(). The supervisor forks a worker
+# process to run the request, forwards signals from the client to the worker, and reports the
+# worker's exit status to the client. A worker killed by a signal is reported as the negated
+# signal number. Never returns.
+def _supervise_request(parser, main, conn):
+    import json
+    import signal
+    import socket
+    import struct
+
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    try:
+        header, fds, _, _ = socket.recv_fds(conn, 4, 3)
+        request = json.loads(_recv_exactly(conn, struct.unpack("!I", header)[0]))
+    except Exception:
+        os._exit(1)
+
+    worker = os.fork()
+    if worker == 0:
+        conn.close()
+        _run_request(parser, main, request, fds)
+
+    for fd in fds:
+        os.close(fd)
+
+    def forward_signals():
+        while len(message := _recv_exactly(conn, 4)) == 4:
+            os.kill(worker, struct.unpack("!i", message)[0])
+
+    threading.Thread(target=forward_signals, daemon=True).start()
+    _, wait_status = os.waitpid(worker, 0)
+    if os.WIFSIGNALED(wait_status):
+        status = -os.WTERMSIG(wait_status)
+    else:
+        status = os.waitstatus_to_exitcode(wait_status)
+    try:
+        conn.sendall(struct.pack("!i", status))
+    finally:
+        os._exit(0)
+
+
+# Run a request in a worker process forked by _supervise_request(). Exit statuses and messages
+# follow the interpreter's own handling of SystemExit. Never returns.
+def _run_request(parser, main, request, fds):
+    import signal
+    import traceback
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", closefd=False, errors="backslashreplace")
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+        signal.signal(signum, signal.default_int_handler if signum == signal.SIGINT else signal.SIG_DFL)
+
+    status = 0
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = request["argv"]
+        result = parser.parse()
+        if main is not None:
+            main(result)
+    except SystemExit as err:
+        status = _exit_status(err)
+    except KeyboardInterrupt:
+        _flush_stdio()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGINT)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    _flush_stdio()
+    os._exit(status)
+
+
+# Returns the exit status for a SystemExit exception, printing its message to stderr if it has
+# one, as the interpreter would if the exception ended the process.
+def _exit_status(err):
+    if err.code is None:
+        return 0
+    elif isinstance(err.code, int):
+        return err.code
+    print(err.code, file=sys.stderr)
+    return 1
+
+
+# Returns exactly `size` bytes read from a socket, or fewer if the connection is closed.
+def _recv_exactly(conn, size):
+    data = b""
+    while len(data) < size and (chunk := conn.recv(size - len(data))):
+        data += chunk
+    return data
+
+
+# Flush the standard output streams, e.g. before forking.
+def _flush_stdio():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+
+
+# A HelpGenerator instance renders help text for a parser from its registered flags, options, and
+# commands, wrapped to the terminal width. Assign an instance to a parser's helptext attribute;
+# the help text is only rendered when it's printed. The `usage` and `description` strings head
+# the help text. If `cache_dir` is specified, rendered help text is memoized in the directory
+# by a hash of the parser's specification and the terminal width. Errors reading or writing
+# the cache are ignored.
+class HelpGenerator:
+
+    def __init__(self, usage=None, description=None, cache_dir=None):
+        self.usage = usage
+        self.description = description
+        self.cache_dir = cache_dir
+
+    def __call__(self, parser):
+        import shutil
+        width = shutil.get_terminal_size().columns
+        sections = self._sections(parser)
+        if self.cache_dir is None:
+            return self._render(sections, width)
+
+        import hashlib
+        spec = repr((self.usage, self.description, sections, width))
+        path = os.path.join(self.cache_dir, f"help-{hashlib.sha256(spec.encode()).hexdigest()}.txt")
+        try:
+            with open(path, encoding="utf-8") as file:
+                return file.read()
+        except OSError:
+            pass
+        helptext = self._render(sections, width)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                file.write(helptext)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+        return helptext
+
+    # Returns a list of (title, entries) pairs for the parser's options, flags, and commands,
+    # where each entry is a (term, description) pair. A command's description is the first line
+    # of its helptext, skipping any usage line; callable helptext isn't invoked.
+    def _sections(self, parser):
+        options = []
+        for option in dict.fromkeys(parser.options.values()):
+            aliases = [alias for alias, o in parser.options.items() if o is option]
+            metavar = option.type.__name__ if option.type in (int, float) else "value"
+            desc = option.helptext or ""
+            if option.default is not None:
+                desc = f"{desc} Default: {option.default}.".strip()
+            options.append((f"{_help_term(aliases)} <{metavar}>", desc))
+
+        flags = []
+        for flag in dict.fromkeys(parser.flags.values()):
+            aliases = [alias for alias, f in parser.flags.items() if f is flag]
+            flags.append((_help_term(aliases), flag.helptext or ""))
+        if parser.helptext is not None:
+            aliases = ["help"] + (["h"] if _is_free(parser, "h") else [])
+            flags.append((_help_term(aliases), "Print this help text and exit."))
+        if parser.version is not None:
+            aliases = ["version"] + (["v"] if _is_free(parser, "v") else [])
+            flags.append((_help_term(aliases), "Print the version number and exit."))
+
+        commands = []
+        for cmd_parser in dict.fromkeys(parser.commands.values()):
+            aliases = [alias for alias, p in parser.commands.items() if p is cmd_parser]
+            summary = ""
+            if isinstance(cmd_parser.helptext, str):
+                lines = [line.strip() for line in cmd_parser.helptext.splitlines()]
+                summary = next((line for line in lines if line and not line.startswith("Usage:")), "")
+            commands.append((", ".join(aliases), summary))
+        if parser.commands and (parser.enable_help_command or parser.help_command):
+            commands.append(("help <command>", "Print the specified command's help text."))
+
+        return [(title, entries) for title, entries in
+            (("Options", options), ("Flags", flags), ("Commands", commands)) if entries]
+
+    # Render the sections in the same layout as a handwritten helptext string.
+    def _render(self, sections, width):
+        import textwrap
+        if self.usage is not None:
+            usage = self.usage
+        else:
+            usage = f"Usage: {os.path.basename(sys.argv[0])}"
+            titles = [title for title, _ in sections]
+            if "Commands" in titles:
+                usage += " [command]"
+            if "Options" in titles or "Flags" in titles:
+                usage += " [flags] [options]"
+        lines = [usage]
+
+        if self.description:
+            lines.append("")
+            for paragraph in textwrap.dedent(self.description).strip().split("\n\n"):
+                lines.extend(textwrap.wrap(
+                    paragraph, width - 2, initial_indent="  ", subsequent_indent="  "
+                ))
+                lines.append("")
+            lines.pop()
+
+        terms = [term for _, entries in sections for term, _ in entries]
+        column = min(max(map(len, terms), default=0) + 6, 32)
+        for title, entries in sections:
+            lines.append("")
+            lines.append(f"{title}:")
+            for term, desc in entries:
+                wrapped = textwrap.wrap(desc, max(width - column, 20))
+                if len(term) + 4 > column or not wrapped:
+                    lines.append(f"  {term}")
+                else:
+                    lines.append(f"  {term:<{column - 2}}{wrapped.pop(0)}")
+                lines.extend(" " * column + line for line in wrapped)
+
+        return "\n".join(lines) + "\n"
+
+
+# Returns the help text term for a flag or option's aliases, single-character aliases first.
+def _help_term(aliases):
+    return ", ".join(_token(alias) for alias in sorted(aliases, key=lambda alias: len(alias) > 1))
+
+
+# Internal class for resolving unique-prefix abbreviations. Built from a dictionary mapping names
+# to targets, where aliases share the same target. Each node of the trie is a dictionary mapping
+# characters to child nodes; the None key stores the (name, target) pair shared by every name
+# below the node, or _AMBIGUOUS if they have different targets, and the True key marks the end
+# of a name. Resolution costs O(len(prefix)) however many names are registered.
+class _PrefixTrie:
+
+    def __init__(self, names):
+        self.root = {}
+        for name, target in names.items():
+            node = self.root
+            for char in name:
+                node = node.setdefault(char, {})
+                entry = node.get(None)
+                if entry is None:
+                    node[None] = (name, target)
+                elif entry is not _AMBIGUOUS and entry[1] is not target:
+                    node[None] = _AMBIGUOUS
+            node[True] = name
+
+    # Returns a (name, candidates) tuple. If the prefix identifies a unique target, name is the
+    # target's first registered name; if it's ambiguous, candidates is a sorted list of names.
+    def resolve(self, prefix):
+        node = self.root
+        for char in prefix:
+            if (node := node.get(char)) is None:
+                return None, None
+        entry = node.get(None)
+        if entry is None:
+            return None, None
+        if entry is not _AMBIGUOUS:
+            return entry[0], None
+        candidates = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if True in node:
+                candidates.append(node[True])
+            stack.extend(child for key, child in node.items() if type(key) is str)
+        return None, sorted(candidates)
+
+
+# Sentinel marking a trie node whose names have different targets.
+_AMBIGUOUS = object()
+
+
+# Internal class for finding the registered names closest to an unrecognised name. Built from a
+# dictionary mapping names to targets, where aliases share the same target. A BK-tree indexes
+# the names by edit distance so a search only visits the subtrees which can contain matches.
+# Each node is a [name, children] pair where children maps distances to child nodes.
+class _BKTree:
+
+    def __init__(self, names):
+        self.names = names
+        self.root = None
+        for name in names:
+            if self.root is None:
+                self.root = [name, {}]
+                continue
+            node = self.root
+            while True:
+                distance = _edit_distance(name, node[0])
+                if (child := node[1].get(distance)) is None:
+                    node[1][distance] = [name, {}]
+                    break
+                node = child
+
+    # Returns up to `limit` names within `max_distance` edits of the query, closest first. Only
+    # the closest alias of each target is included. Names which differ from the query in more
+    # than a third of their characters are too dissimilar to be useful and are skipped.
+    def search(self, query, max_distance, limit):
+        matches = []
+        stack = [self.root] if self.root else []
+        while stack:
+            name, children = stack.pop()
+            distance = _edit_distance(query, name)
+            if distance <= max_distance and distance * 3 <= max(len(query), len(name)):
+                matches.append((distance, name))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results, targets = [], []
+        for _, name in sorted(matches):
+            if not any(target is self.names[name] for target in targets):
+                targets.append(self.names[name])
+                results.append(name)
+        return results[:limit]
+
+
+# Returns the Levenshtein edit distance between two strings.
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        previous = current
+    return previous[-1]
+
+
+# An Instrumentation instance collects timings, counters, and events while parsing. Assign an
+# instance to a parser's `instrumentation` attribute to enable it, or set the ARGSLIB_PROFILE
+# environment variable to 'text' or 'json' to print a report to stderr when the process exits.
+#
+# Hooks registered using on() are called with the following arguments for each event:
+#
+#   'token': (parser, token, kind) for each token classified by the parser
+#   'flag': (name, count) each time a flag is counted
+#   'option': (name, raw_value, seconds) each time an option value is converted
+#   'command': (name,) each time a command is entered
+#   'callback': (name, seconds) each time a command callback returns
+#
+# Token kinds are 'switch', 'long', 'short', 'equals', 'positional', 'command', and 'help'.
+class Instrumentation:
+
+    def __init__(self):
+
+        # Stores the total time in seconds spent in each phase of parsing, indexed by phase:
+        # 'argstrings', 'parse', 'convert', and 'callbacks'. The 'parse' phase includes the
+        # time spent converting option values and calling command callbacks.
+        self.timings = {}
+
+        # Stores the number of times each event has occurred, indexed by event name, and the
+        # number of tokens of each kind, indexed by 'token:<kind>'.
+        self.counters = {}
+
+        # Stores registered hook functions indexed by event name.
+        self.hooks = {}
+
+    # Register a hook function to be called for the specified event.
+    def on(self, event, func):
+        self.hooks.setdefault(event, []).append(func)
+
+    # Returns the timings and counters as a JSON string.
+    def to_json(self):
+        import json
+        return json.dumps({"timings": self.timings, "counters": self.counters}, indent=2, sort_keys=True)
+
+    # Returns the timings and counters as a plain-text report.
+    def report(self):
+        lines = ["Timings:"]
+        for phase, seconds in sorted(self.timings.items()):
+            lines.append(f"  {phase}: {seconds * 1000:.3f} ms")
+        if not self.timings:
+            lines.append("  [none]")
+        lines.append("\nCounters:")
+        for name, count in sorted(self.counters.items()):
+            lines.append(f"  {name}: {count}")
+        if not self.counters:
+            lines.append("  [none]")
+        return "\n".join(lines)
+
+    def _add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def _emit(self, event, *args):
+        self.counters[event] = self.counters.get(event, 0) + 1
+        for func in self.hooks.get(event, ()):
+            func(*args)
+
+    def _converted(self, option, raw_value, seconds):
+        self._add_time("convert", seconds)
+        self._emit("option", option.name, raw_value, seconds)
+
+    # Classify a token in the same way as ArgParser._parse_stream().
+    def _token(self, parser, arg, is_first_arg):
+        if arg == "--":
+            kind = "switch"
+        elif arg.startswith("--"):
+            kind = "equals" if "=" in arg else "long"
+        elif arg.startswith("-") and arg != "-" and not arg[1].isdigit():
+            kind = "equals" if "=" in arg else "short"
+        elif is_first_arg and arg in parser.commands:
+            kind = "command"
+        elif is_first_arg and arg == "help" and (parser.enable_help_command or parser.help_command):
+            kind = "help"
+        else:
+            kind = "positional"
+        key = f"token:{kind}"
+        self.counters[key] = self.counters.get(key, 0) + 1
+        for func in self.hooks.get("token", ()):
+            func(parser, arg, kind)
+
+
+# Internal class for storing an instrumented result's flag counts. Emits a 'flag' event each
+# time a count is set, so the parsing code doesn't need to check for instrumentation.
+class _InstrumentedCounts(dict):
+
+    __slots__ = ("instr",)
+
+    def __init__(self, instr):
+        super().__init__()
+        self.instr = instr
+
+    def __setitem__(self, flag, count):
+        super().__setitem__(flag, count)
+        self.instr._emit("flag", flag.name, count)
+
+
+# Stores the Instrumentation instance enabled by the ARGSLIB_PROFILE environment variable.
+_profile = None
+
+# True once the ARGSLIB_PROFILE environment variable has been read.
+_profile_checked = False
+
+
+# Returns the Instrumentation instance enabled by the ARGSLIB_PROFILE environment variable, or
+# None if the variable isn't set. The variable is only read on the first call so parsing
+# doesn't pay for an environment lookup. The report is printed to stderr when the process exits.
+def _env_instrumentation():
+    global _profile, _profile_checked
+    if not _profile_checked:
+        _profile_checked = True
+        if fmt := os.environ.get("ARGSLIB_PROFILE"):
+            import atexit
+            _profile = Instrumentation()
+            atexit.register(lambda: print(
+                _profile.to_json() if fmt == "json" else _profile.report(), file=sys.stderr
+            ))
+    return _profile
+
+
+# Generator function which walks a parser's command tree for completion_script(), yielding a
+# _CompletionLevel instance for each parser. Runs any deferred command loaders.
+def _completion_levels(parser, path=""):
+    parser._load()
+    level = _CompletionLevel(path)
+
+    for flag in dict.fromkeys(parser.flags.values()):
+        level.flags.append([alias for alias, f in parser.flags.items() if f is flag])
+    for option in dict.fromkeys(parser.options.values()):
+        aliases = [alias for alias, o in parser.options.items() if o is option]
+        level.options.append((aliases, option.complete))
+    if parser.helptext is not None:
+        level.flags.append(["help"] + (["h"] if _is_free(parser, "h") else []))
+    if parser.version is not None:
+        level.flags.append(["version"] + (["v"] if _is_free(parser, "v") else []))
+
+    children = []
+    for cmd_parser in dict.fromkeys(parser.commands.values()):
+        aliases = [alias for alias, p in parser.commands.items() if p is cmd_parser]
+        level.commands.append((aliases, f"{path} {aliases[0]}"))
+        children.append((cmd_parser, f"{path} {aliases[0]}"))
+    if parser.commands and (parser.enable_help_command or parser.help_command):
+        level.commands.append((["help"], None))
+
+    yield level
+    for cmd_parser, cmd_path in children:
+        yield from _completion_levels(cmd_parser, cmd_path)
+
+
+# Returns true if the single-character name isn't registered as a flag or option.
+def _is_free(parser, char):
+    return char not in parser.flags and char not in parser.options
+
+
+# Stores the completion data for a single parser in a command tree. The path is a string of the
+# form ' cmd subcmd' identifying the parser, or the empty string for the root parser.
+class _CompletionLevel:
+
+    def __init__(self, path):
+        self.path = path
+        self.flags = []
+        self.options = []
+        self.commands = []
+
+    # Returns the list of flag and option tokens, e.g. '--foo' and '-f'.
+    def tokens(self):
+        aliases = self.flags + [aliases for aliases, _ in self.options]
+        return [_token(alias) for group in aliases for alias in group]
+
+
+# Returns the command line token for a flag or option alias.
+def _token(alias):
+    return f"-{alias}" if len(alias) == 1 else f"--{alias}"
+
+
+# Returns a bash completion script for completion_script().
+def _bash_completion(prog, levels):
+    func = "_argslib_" + re.sub(r"\W", "_", prog)
+    lines = [
+        f"{func}() {{",
+        '    local cur=${COMP_WORDS[COMP_CWORD]} path= first=1 value_of= word i',
+        "    for ((i = 1; i < COMP_CWORD; i++)); do",
+        "        word=${COMP_WORDS[i]}",
+        "        if [[ -n $value_of ]]; then value_of=; continue; fi",
+        "        if [[ $word == -- ]]; then return; fi",
+        "        if ((first)); then",
+        '            case "$path $word" in',
+    ]
+    for level in levels:
+        for aliases, cmd_path in level.commands:
+            if cmd_path is not None:
+                patterns = "|".join(_sh_quote(f"{level.path} {alias}") for alias in aliases)
+                lines.append(f"                {patterns}) path={_sh_quote(cmd_path)}; continue;;")
+    lines += [
+        "            esac",
+        "        fi",
+        '        case "$path $word" in',
+    ]
+    for level in levels:
+        for aliases, _ in level.options:
+            patterns = "|".join(_sh_quote(f"{level.path} {_token(alias)}") for alias in aliases)
+            lines.append(f"            {patterns}) value_of={_sh_quote(f'{level.path} {aliases[0]}')};;")
+    lines += [
+        "        esac",
+        "        first=0",
+        "    done",
+        "    if [[ -n $value_of ]]; then",
+        '        case "$value_of" in',
+    ]
+    for level in levels:
+        for aliases, complete in level.options:
+            if complete == "file":
+                action = 'COMPREPLY=($(compgen -f -- "$cur"))'
+            elif complete == "dir":
+                action = 'COMPREPLY=($(compgen -d -- "$cur"))'
+            elif complete:
+                action = f'COMPREPLY=($(compgen -W {_sh_quote(" ".join(complete))} -- "$cur"))'
+            else:
+                continue
+            lines.append(f"            {_sh_quote(f'{level.path} {aliases[0]}')}) {action};;")
+    lines += [
+        "        esac",
+        "        return",
+        "    fi",
+        "    local words= commands=",
+        '    case "$path" in',
+    ]
+    for level in levels:
+        commands = " ".join(alias for aliases, _ in level.commands for alias in aliases)
+        tokens = " ".join(level.tokens())
+        lines.append(f'        {_sh_quote(level.path)}) words={_sh_quote(tokens)}; ((first)) && commands={_sh_quote(commands)};;')
+    lines += [
+        "    esac",
+        '    if [[ $cur == -* ]]; then',
+        '        COMPREPLY=($(compgen -W "$words" -- "$cur"))',
+        '    elif [[ -n $commands ]]; then',
+        '        COMPREPLY=($(compgen -W "$commands" -- "$cur"))',
+        "    fi",
+        "}",
+        "",
+        f"complete -o bashdefault -o default -F {func} {_sh_quote(prog)}",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+# Returns a fish completion script for completion_script().
+def _fish_completion(prog, levels):
+    func = "__argslib_" + re.sub(r"\W", "_", prog)
+    lines = [
+        f"function {func}_state",
+        "    set -l path ''",
+        "    set -l first 1",
+        "    set -l skip 0",
+        "    for word in (commandline -opc)[2..-1]",
+        "        if test $skip = 1",
+        "            set skip 0",
+        "            continue",
+        "        end",
+        "        if test $first = 1",
+        '            switch "$path $word"',
+    ]
+    for level in levels:
+        for aliases, cmd_path in level.commands:
+            if cmd_path is not None:
+                patterns = " ".join(_sh_quote(f"{level.path} {alias}") for alias in aliases)
+                lines.append(f"                case {patterns}")
+                lines.append(f"                    set path {_sh_quote(cmd_path)}")
+                lines.append(f"                    continue")
+    lines += [
+        "            end",
+        "        end",
+        '        switch "$path $word"',
+    ]
+    option_patterns = [
+        _sh_quote(f"{level.path} {_token(alias)}")
+        for level in levels for aliases, _ in level.options for alias in aliases
+    ]
+    if option_patterns:
+        lines.append(f"            case {' '.join(option_patterns)}")
+        lines.append("                set skip 1")
+    lines += [
+        "        end",
+        "        set first 0",
+        "    end",
+        '    echo "$path:$first"',
+        "end",
+        "",
+    ]
+    for level in levels:
+        condition = f'string match -q -- "{level.path}:*" ({func}_state)'
+        for aliases in level.flags:
+            lines.append(f"complete -c {_sh_quote(prog)} -n {_sh_quote(condition)} {_fish_names(aliases)}")
+        for aliases, complete in level.options:
+            if complete == "file":
+                action = "-r -F"
+            elif complete == "dir":
+                action = "-x -a '(__fish_complete_directories)'"
+            elif complete:
+                action = f"-x -a {_sh_quote(' '.join(complete))}"
+            else:
+                action = "-r"
+            lines.append(f"complete -c {_sh_quote(prog)} -n {_sh_quote(condition)} {_fish_names(aliases)} {action}")
+        commands = " ".join(alias for aliases, _ in level.commands for alias in aliases)
+        if commands:
+            condition = f'test ({func}_state) = "{level.path}:1"'
+            lines.append(f"complete -c {_sh_quote(prog)} -n {_sh_quote(condition)} -f -a {_sh_quote(commands)}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+# Returns the fish -l and -s arguments for a list of flag or option aliases.
+def _fish_names(aliases):
+    return " ".join(f"-s {alias}" if len(alias) == 1 else f"-l {alias}" for alias in aliases)
+
+
+# Quotes a string for use in a shell script.
+def _sh_quote(string):
+    return "'" + string.replace("'", "'\\''") + "'"
+
+
+# A Batch instance wraps a converter which accepts a list of raw option values and returns a
+# sequence of converted values, e.g. an array. Pass it as the `type` of a heavily repeated
+# option to convert all its values in a single call after parsing.
+class Batch:
+
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, str_vals):
+        return self.func(str_vals)
+
+
+def _int_array(str_vals):
+    return array.array("q", map(int, str_vals))
+
+
+def _float_array(str_vals):
+    return array.array("d", map(float, str_vals))
+
+
+# Batch converters which store int and float values in an array.array.
+int_array = Batch(_int_array)
+float_array = Batch(_float_array)
+
+
 # Internal class for storing option data.
 class Option:
 
-    def __init__(self, opt_type, def_value):
+    __slots__ = (
+        "name", "type", "default", "lazy", "complete", "env", "config", "helptext", "batch",
+    )
+
+    def __init__(
+        self, name, opt_type, def_value, lazy=False, complete=None, env=None, config=None,
+        helptext=None,
+    ):
+        self.name = name
         self.type = opt_type
         self.default = def_value
-        self.values = []
-
-    @property
-    def value(self):
-        if self.values:
-            return self.values[-1]
-        else:
-            return self.default
-
-    def try_append_value(self, str_val):
+        self.lazy = lazy
+        self.complete = complete
+        self.env = env
+        self.config = config
+        self.helptext = helptext
+        self.batch = type(opt_type) is Batch
+        if self.batch:
+            self.lazy = False
+
+    # Lazy options append the raw value for conversion on first retrieval. Batch options append
+    # the raw value for conversion at the end of parsing.
+    def try_append_value(self, values, str_val):
+        if self.batch:
+            values.append(str_val)
+            return True
+        if self.lazy:
+            values.append(_Unconverted(str_val))
+            return True
         try:
-            self.values.append(self.type(str_val))
+            if type(str_val) is bytes:
+                values.append(self.convert(str_val))
+            else:
+                values.append(self.type(str_val))
             return True
         except:
             return False
 
+    # In bytes mode, string-valued options keep their raw bytes values. A single value for a
+    # batch option, e.g. a fallback value, is converted as a batch of one.
+    def convert(self, str_val):
+        if self.type is str and type(str_val) is bytes:
+            return str_val
+        if self.batch:
+            return self.type([str_val])[-1]
+        return self.type(str_val)
+
+
+# Internal class for storing a lazy option's raw value until it's converted.
+class _Unconverted:
+
+    __slots__ = ("str_val",)
+
+    def __init__(self, str_val):
+        self.str_val = str_val
+
 
 # Internal class for storing flag data.
 class Flag:
 
-    def __init__(self):
-        self.count = 0
+    __slots__ = ("name", "helptext")
+
+    def __init__(self, name, helptext=None):
+        self.name = name
+        self.helptext = helptext
+
 
+# Returns a stream over an iterable of arguments, starting after the first `start` arguments.
+def _arg_stream(args, start=0):
+    if type(args) in (list, tuple):
+        return ArgStream(args, start)
+    return _LazyArgStream(args, start)
 
-# Internal class for making a list of arguments available as a stream.
+
+# Internal class for making a list or tuple of arguments available as a stream. If the
+# arguments are a tuple, the remaining arguments can be taken as a view without copying them.
 class ArgStream:
 
-    def __init__(self, args):
-        self.args = list(args)
-        self.index = 0
+    __slots__ = ("source", "index", "length")
+
+    def __init__(self, args, start=0):
+        self.source = args
+        self.index = start
+        self.length = len(args)
 
     def next(self):
         self.index += 1
-        return self.args[self.index - 1]
+        return self.source[self.index - 1]
 
     def has_next(self):
-        return self.index < len(self.args)
+        return self.index < self.length
+
+    # Returns true if the stream's arguments are bytes, judging by the next argument.
+    def is_bytes(self):
+        return self.index < self.length and type(self.source[self.index]) is bytes
+
+    # Consume the remaining arguments, returning them as an ArgsView over the source if it's a
+    # tuple, or as a list. A list source is copied with a single slice so the list returned
+    # never aliases the caller's list.
+    def rest(self):
+        if self.index >= self.length:
+            return []
+        if type(self.source) is tuple:
+            rest = ArgsView(self.source, self.index, self.length)
+        else:
+            rest = self.source[self.index:]
+        self.index = self.length
+        return rest
+
+
+# Internal class for making any other iterable of arguments available as a stream. Arguments
+# are read lazily from the underlying iterator with one argument of lookahead.
+class _LazyArgStream:
+
+    __slots__ = ("iterator", "lookahead", "index")
+
+    def __init__(self, args, start=0):
+        self.iterator = iter(args) if start == 0 else itertools.islice(args, start, None)
+        self.lookahead = next(self.iterator, _END)
+        self.index = start
+
+    def next(self):
+        arg = self.lookahead
+        self.lookahead = next(self.iterator, _END)
+        self.index += 1
+        return arg
+
+    def has_next(self):
+        return self.lookahead is not _END
+
+    # Returns true if the stream's arguments are bytes, judging by the next argument.
+    def is_bytes(self):
+        return type(self.lookahead) is bytes
+
+    # Consume the remaining arguments, returning them as a list.
+    def rest(self):
+        if self.lookahead is _END:
+            return []
+        rest = [self.lookahead]
+        rest.extend(self.iterator)
+        self.index += len(rest)
+        self.lookahead = _END
+        return rest
+
+
+# Sentinel marking the end of a _LazyArgStream.
+_END = object()
+
+
+# An ArgsView instance is a sequence of positional arguments backed by a slice of the argument
+# tuple being parsed, e.g. the application's command line arguments, so long runs of arguments
+# following a '--' switch aren't copied. It supports the same operations as a list; the
+# arguments are copied into a private list the first time the view is modified. Slicing or
+# multiplying a view returns a list.
+class ArgsView(collections.abc.MutableSequence):
+
+    __slots__ = ("_source", "_start", "_stop", "_list")
+
+    def __init__(self, source, start=0, stop=None):
+        self._source = source
+        self._start = start
+        self._stop = len(source) if stop is None else stop
+        self._list = None
+
+    # Returns the view's private list of arguments, copying them from the source on first use.
+    def _copy(self):
+        if self._list is None:
+            self._list = list(self._source[self._start:self._stop])
+            self._source = None
+        return self._list
+
+    def __len__(self):
+        return len(self._list) if self._list is not None else self._stop - self._start
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        indexes = range(self._start, self._stop)[index]
+        if type(indexes) is int:
+            return self._source[indexes]
+        elif indexes.step == 1:
+            return list(self._source[indexes.start:indexes.stop])
+        return [self._source[i] for i in indexes]
+
+    def __iter__(self):
+        if self._list is not None:
+            return iter(self._list)
+        return map(self._source.__getitem__, range(self._start, self._stop))
+
+    def __setitem__(self, index, value):
+        self._copy()[index] = value
+
+    def __delitem__(self, index):
+        del self._copy()[index]
+
+    def insert(self, index, value):
+        self._copy().insert(index, value)
+
+    def append(self, value):
+        self._copy().append(value)
+
+    def extend(self, values):
+        self._copy().extend(values)
+
+    def __iadd__(self, values):
+        self._copy().extend(values)
+        return self
+
+    def sort(self, *, key=None, reverse=False):
+        self._copy().sort(key=key, reverse=reverse)
+
+    def copy(self):
+        return list(self)
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+    def __mul__(self, count):
+        return list(self) * count
+
+    __rmul__ = __mul__
+
+    def __imul__(self, count):
+        self._copy().__imul__(count)
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, (list, ArgsView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, (list, ArgsView)):
+            return list(self) < list(other)
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, (list, ArgsView)):
+            return list(self) <= list(other)
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, (list, ArgsView)):
+            return list(self) > list(other)
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, (list, ArgsView)):
+            return list(self) >= list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# Generator function which lazily reads arguments from a binary file, defaulting to stdin. Arguments
+# are separated by `sep`, typically a newline or "\0" for the output of `find -print0`. The file is
+# read in blocks of `blocksize` bytes so memory use is constant regardless of the input size.
+# Raises InvalidUnicode if an argument is not a valid unicode string.
+def read_args(file=None, sep="\n", blocksize=65536):
+    file = sys.stdin.buffer if file is None else file
+    sep = sep.encode()
+    fsencoding = sys.getfilesystemencoding()
+    remainder = b""
+    while block := file.read(blocksize):
+        *args_as_bytes, remainder = (remainder + block).split(sep)
+        for arg_as_bytes in args_as_bytes:
+            yield _decode_arg(arg_as_bytes, fsencoding)
+    if remainder:
+        yield _decode_arg(remainder, fsencoding)
+
+
+# Matches a single whitespace-delimited argument in a response file. Arguments can contain
+# single-quoted and double-quoted sections and backslash escapes.
+_RESPONSE_ARG = re.compile(rb"""(?:[^\s'"\\]+|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+""", re.DOTALL)
+
+
+# Matches the quoted, escaped, and literal sections of a response file argument.
+_RESPONSE_PART = re.compile(rb"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|([^'"\\]+)""", re.DOTALL)
+
+
+# Matches a backslash escape inside a double-quoted section.
+_RESPONSE_ESCAPE = re.compile(rb"\\(.)", re.DOTALL)
+
+
+# Caches tokenized response files indexed by (path, mtime, size, as_bytes).
+_response_file_cache = {}
+
+
+# Generator function which expands @path arguments into the arguments stored in the response
+# file at path, recursively. Arguments which don't name an existing file are left untouched.
+# Raises ArgsError if a response file includes itself or can't be tokenized.
+# Bytes arguments expand to bytes arguments.
+def _expand_response_files(args, use_cache, active=()):
+    for arg in args:
+        as_bytes = type(arg) is bytes
+        if arg[:1] == (b"@" if as_bytes else "@") and os.path.isfile(arg[1:]):
+            path = os.path.realpath(arg[1:])
+            if path in active:
+                raise ArgsError(f"response file '{os.fsdecode(arg[1:])}' includes itself")
+            tokens = _read_response_file(path, use_cache, as_bytes)
+            yield from _expand_response_files(tokens, use_cache, active + (path,))
+        else:
+            yield arg
+
+
+# Generator function which yields the arguments stored in a response file. The file is
+# memory-mapped and tokenized incrementally rather than being read into memory in one go.
+def _read_response_file(path, use_cache, as_bytes):
+    if use_cache:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, as_bytes)
+        if (tokens := _response_file_cache.get(key)) is None:
+            tokens = list(_read_response_file(path, False, as_bytes))
+            _response_file_cache[key] = tokens
+        yield from tokens
+        return
+
+    fsencoding = sys.getfilesystemencoding()
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            end = 0
+            for match in _RESPONSE_ARG.finditer(buffer):
+                _check_response_gap(path, buffer[end:match.start()])
+                end = match.end()
+                arg_as_bytes = _unquote_response_arg(match.group())
+                yield arg_as_bytes if as_bytes else _decode_arg(arg_as_bytes, fsencoding)
+            _check_response_gap(path, buffer[end:])
+
+
+# Raises ArgsError if the text between two response file arguments isn't whitespace, i.e. if
+# the tokenizer skipped an unterminated quote or a trailing backslash.
+def _check_response_gap(path, gap):
+    if gap and not gap.isspace():
+        if b"'" in gap or b'"' in gap:
+            raise ArgsError(f"no closing quotation in response file '{os.fsdecode(path)}'")
+        raise ArgsError(f"no escaped character in response file '{os.fsdecode(path)}'")
+
+
+# Strip the quotes and backslash escapes from a response file argument.
+def _unquote_response_arg(arg):
+    parts = []
+    for single, double, escaped, literal in _RESPONSE_PART.findall(arg):
+        if double:
+            parts.append(_RESPONSE_ESCAPE.sub(rb"\1", double))
+        else:
+            parts.append(single or escaped or literal)
+    return b"".join(parts)
+
+
+# Decode an argument, raising InvalidUnicode if it is not a valid unicode string.
+def _decode_arg(arg_as_bytes, encoding):
+    try:
+        return arg_as_bytes.decode(encoding=encoding)
+    except UnicodeError as err:
+        raise InvalidUnicode("argument is not a valid unicode string") from err
+
+
+# Caches config file snapshots indexed by (path, mtime, size, keys).
+_config_file_cache = {}
+
+
+# Returns a snapshot of the values of the specified dotted `keys` in the config file at `path`,
+# or an empty dict if the file doesn't exist. Snapshots are cached in memory and, if `cache_dir`
+# is specified, written to disk as JSON so other processes can skip parsing the file. Snapshots
+# JSON can't represent, e.g. TOML dates, aren't written, and errors writing are ignored.
+def _read_config_file(path, keys, cache_dir=None):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, keys)
+    if (snapshot := _config_file_cache.get(key)) is not None:
+        return snapshot
+
+    if cache_dir is None:
+        snapshot = _parse_config_file(path, keys)
+    else:
+        import hashlib
+        import json
+        filename = hashlib.sha256(repr(key).encode()).hexdigest() + ".json"
+        snapshot_path = os.path.join(cache_dir, filename)
+        try:
+            with open(snapshot_path, "rb") as file:
+                snapshot = json.load(file)
+            if type(snapshot) is not dict:
+                raise ValueError("invalid snapshot")
+        except (OSError, ValueError):
+            snapshot = _parse_config_file(path, keys)
+            temp_path = f"{snapshot_path}.{os.getpid()}"
+            try:
+                data = json.dumps(snapshot)
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(temp_path, "w") as file:
+                    file.write(data)
+                os.replace(temp_path, snapshot_path)
+            except (OSError, TypeError, ValueError):
+                pass
+
+    _config_file_cache[key] = snapshot
+    return snapshot
+
+
+# Parse a TOML, JSON, or INI config file, choosing the format by the file extension, and return
+# the values of the specified dotted keys. INI keys have the form "section.key".
+def _parse_config_file(path, keys):
+    import json
+    with open(path, "rb") as file:
+        data = file.read()
+    try:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".toml":
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ArgsError("TOML config files require Python 3.11 or the tomli package")
+            config = tomllib.loads(data.decode())
+        elif ext == ".json":
+            config = json.loads(data)
+        else:
+            import configparser
+            ini = configparser.ConfigParser(interpolation=None)
+            ini.read_string(data.decode())
+            config = {name: dict(section) for name, section in ini.items()}
+    except ArgsError:
+        raise
+    except Exception as err:
+        raise ArgsError(f"cannot parse config file '{path}': {err}") from err
+
+    snapshot = {}
+    for key in keys:
+        value = config
+        for part in key.split("."):
+            if type(value) is not dict or part not in value:
+                break
+            value = value[part]
+        else:
+            snapshot[key] = value
+    return snapshot
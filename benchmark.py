@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+# Benchmarks: run using `python3 benchmark.py --help`.
+# ------------------------------------------------------------------------------
+
+import argparse
+import argslib
+import getopt
+import json
+import sys
+import time
+import tracemalloc
+
+
+helptext = """
+Usage: benchmark.py [options] [workloads...]
+
+  Benchmarks the parser against a set of generated workloads and compares it
+  with the standard library's argparse and getopt modules. Runs all workloads
+  if none are specified.
+
+  Each measurement is the best of several timed runs after a warm-up run.
+  Results are compared with the baseline file if it exists. The run fails if
+  the parser's throughput for any workload drops below the baseline by more
+  than the tolerance.
+
+Options:
+  -b, --baseline <path>     Baseline file. Default: benchmark_baseline.json.
+  -r, --repeats <int>       Timed runs per measurement. Default: 5.
+  -s, --seconds <float>     Minimum time per timed run. Default: 0.2.
+  -t, --tolerance <float>   Allowed fractional slowdown. Default: 0.2.
+
+Flags:
+  -h, --help                Print this help text and exit.
+  -n, --no-compare          Skip the argparse and getopt comparisons.
+  -u, --update-baseline     Save the results as the new baseline.
+"""
+
+
+# ------------------------------------------------------------------------------
+# Workloads.
+# ------------------------------------------------------------------------------
+
+
+# A workload supplies an argument list and equivalent argslib, argparse, and getopt parsers.
+# The argslib factory returns an ArgParser instance; the others return a function which parses
+# an argument list. The getopt factory is None if getopt can't parse the workload. If `use` is
+# specified, it's called with each argslib ParseResult, e.g. to read the parsed values.
+class Workload:
+
+    def __init__(self, name, args, make_argslib, make_argparse, make_getopt=None, use=None):
+        self.name = name
+        self.args = args
+        self.make_argslib = make_argslib
+        self.make_argparse = make_argparse
+        self.make_getopt = make_getopt
+        self.use = use
+
+
+# Thousands of registered flags and options, a sample of which are used in long form.
+def registry_workload(num_names=2000, num_used=100, repeat=20):
+    args = []
+    for i in range(0, num_names, num_names // num_used):
+        args += [f"--flag{i}", f"--opt{i}", "value"]
+    args *= repeat
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        for i in range(num_names):
+            parser.flag(f"flag{i}")
+            parser.option(f"opt{i}")
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser()
+        for i in range(num_names):
+            parser.add_argument(f"--flag{i}", action="count")
+            parser.add_argument(f"--opt{i}", action="append")
+        return parser.parse_args
+
+    def make_getopt():
+        longopts = [f"flag{i}" for i in range(num_names)] + [f"opt{i}=" for i in range(num_names)]
+        return lambda args: getopt.getopt(args, "", longopts)
+
+    return Workload("registry", args, make_argslib, make_argparse, make_getopt)
+
+
+# Long blocks of condensed single-character flags.
+def condensed_workload(repeat=200):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    args = [f"-{letters}"] * repeat
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        for letter in letters:
+            parser.flag(letter)
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser(add_help=False)
+        for letter in letters:
+            parser.add_argument(f"-{letter}", action="count")
+        return parser.parse_args
+
+    def make_getopt():
+        return lambda args: getopt.getopt(args, letters)
+
+    return Workload("condensed", args, make_argslib, make_argparse, make_getopt)
+
+
+# A single numeric option repeated thousands of times.
+def repetition_workload(repeat=10000):
+    args = ["--point", "1.5"] * repeat
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        parser.option("point", type=float)
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--point", type=float, action="append")
+        return parser.parse_args
+
+    def make_getopt():
+        return lambda args: [float(value) for _, value in getopt.getopt(args, "", ["point="])[0]]
+
+    return Workload("repetition", args, make_argslib, make_argparse, make_getopt)
+
+
+# A deeply nested chain of commands.
+def nested_workload(depth=30):
+    args = [f"cmd{i}" for i in range(depth)] + ["--flag", "arg"]
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        cmd_parser = parser
+        for i in range(depth):
+            cmd_parser = cmd_parser.command(f"cmd{i}")
+        cmd_parser.flag("flag")
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser()
+        cmd_parser = parser
+        for i in range(depth):
+            cmd_parser = cmd_parser.add_subparsers(dest=f"cmd{i}").add_parser(f"cmd{i}")
+        cmd_parser.add_argument("--flag", action="count")
+        cmd_parser.add_argument("args", nargs="*")
+        return parser.parse_args
+
+    return Workload("nested", args, make_argslib, make_argparse)
+
+
+# A huge list of positional arguments following a '--' switch. Each parser's positional
+# arguments are iterated over so the workload measures more than creating a view.
+def positional_workload(num_args=100000):
+    args = ["--flag", "--"] + [f"file{i}.txt" for i in range(num_args)]
+
+    def use_args(args):
+        return len(args) == sum(1 for _ in args)
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        parser.flag("flag")
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--flag", action="count")
+        parser.add_argument("args", nargs="*")
+        return lambda args: use_args(parser.parse_args(args).args)
+
+    def make_getopt():
+        return lambda args: use_args(getopt.getopt(args, "", ["flag"])[1])
+
+    def use(result):
+        use_args(result.args)
+
+    return Workload("positional", args, make_argslib, make_argparse, make_getopt, use)
+
+
+# Options using the --name=value syntax.
+def equals_workload(num_names=100, repeat=100):
+    args = [f"--opt{i}=value" for i in range(num_names)] * repeat
+
+    def make_argslib():
+        parser = argslib.ArgParser()
+        for i in range(num_names):
+            parser.option(f"opt{i}")
+        return parser
+
+    def make_argparse():
+        parser = argparse.ArgumentParser()
+        for i in range(num_names):
+            parser.add_argument(f"--opt{i}", action="append")
+        return parser.parse_args
+
+    def make_getopt():
+        return lambda args: getopt.getopt(args, "", [f"opt{i}=" for i in range(num_names)])
+
+    return Workload("equals", args, make_argslib, make_argparse, make_getopt)
+
+
+WORKLOADS = [
+    registry_workload,
+    condensed_workload,
+    repetition_workload,
+    nested_workload,
+    positional_workload,
+    equals_workload,
+]
+
+
+# ------------------------------------------------------------------------------
+# Measurement.
+# ------------------------------------------------------------------------------
+
+
+# Stores the measurements for a single parser on a single workload.
+class Measurement:
+
+    def __init__(self, tokens_per_sec, peak_bytes):
+        self.tokens_per_sec = tokens_per_sec
+        self.ns_per_token = 1e9 / tokens_per_sec
+        self.peak_bytes = peak_bytes
+
+
+# Measure the throughput and peak memory use of a parse function on an argument list. After
+# a warm-up run, the argument list is parsed repeatedly for at least `seconds` in each of
+# `repeats` timed runs; the throughput is the best of the timed runs, as slower runs measure
+# interference from the rest of the system rather than the parser.
+def measure(parse, args, seconds, repeats):
+    tracemalloc.start()
+    parse(args)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timed_run(parse, args, seconds)
+    best = max(timed_run(parse, args, seconds) for _ in range(repeats))
+    return Measurement(best, peak_bytes)
+
+
+# Parse an argument list repeatedly for at least `seconds`, returning the tokens per second.
+def timed_run(parse, args, seconds):
+    runs = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        parse(args)
+        runs += 1
+    return runs * len(args) / elapsed
+
+
+# Returns a function which parses an argument list using an ArgParser and the workload's `use`
+# function, if it has one.
+def argslib_parse(workload, parser):
+    if workload.use is None:
+        return parser.parse
+    return lambda args: workload.use(parser.parse(args))
+
+
+# Returns a list of (label, parse function) pairs for the parsers being compared on a workload.
+def parsers_for(workload, compare):
+    parsers = [
+        ("argslib", argslib_parse(workload, workload.make_argslib())),
+        ("argslib (compiled)", argslib_parse(workload, workload.make_argslib().compile())),
+    ]
+    if compare:
+        parsers.append(("argparse", workload.make_argparse()))
+        if workload.make_getopt:
+            parsers.append(("getopt", workload.make_getopt()))
+    return parsers
+
+
+def main():
+    parser = argslib.ArgParser(helptext)
+    parser.option("baseline b", default="benchmark_baseline.json")
+    parser.option("repeats r", type=int, default=5)
+    parser.option("seconds s", type=float, default=0.2)
+    parser.option("tolerance t", type=float, default=0.2)
+    parser.flag("no-compare n")
+    parser.flag("update-baseline u")
+    result = parser.parse()
+
+    workloads = [make_workload() for make_workload in WORKLOADS]
+    if result.args:
+        workloads = [workload for workload in workloads if workload.name in result.args]
+
+    try:
+        with open(result.value("baseline")) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        baseline = {}
+
+    results = {}
+    regressions = []
+    print(f"{'workload':<12} {'parser':<20} {'tokens/sec':>14} {'ns/token':>10} {'peak KiB':>10}")
+    for workload in workloads:
+        for label, parse in parsers_for(workload, not result.found("no-compare")):
+            m = measure(parse, workload.args, result.value("seconds"), result.value("repeats"))
+            print(
+                f"{workload.name:<12} {label:<20} {m.tokens_per_sec:>14,.0f} "
+                f"{m.ns_per_token:>10,.1f} {m.peak_bytes / 1024:>10,.1f}"
+            )
+            if label.startswith("argslib"):
+                key = f"{workload.name}/{label}"
+                results[key] = m.tokens_per_sec
+                if key in baseline:
+                    floor = baseline[key] * (1 - result.value("tolerance"))
+                    if m.tokens_per_sec < floor:
+                        regressions.append(f"{key}: {m.tokens_per_sec:,.0f} < {floor:,.0f} tokens/sec")
+        print()
+
+    if result.found("update-baseline"):
+        with open(result.value("baseline"), "w") as file:
+            json.dump(dict(baseline, **results), file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {result.value('baseline')}.")
+    elif regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
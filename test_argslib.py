@@ -3,7 +3,13 @@
 # ------------------------------------------------------------------------------
 
 import argslib
+import array
+import asyncio
+import io
+import json
 import pytest
+import random
+import sys
 
 
 # ------------------------------------------------------------------------------
@@ -244,6 +250,40 @@ def test_option_parsing_switch():
     assert len(parser.args) == 3
 
 
+def test_option_parsing_switch_list():
+    argv = ["--", "a", "b"]
+    args = argslib.ArgParser().parse(argv).args
+    assert type(args) is list
+    argv.append("c")
+    assert args == ["a", "b"]
+
+
+def test_option_parsing_switch_view():
+    argv = ("--", "a", "b", "c", "d")
+    args = argslib.ArgParser().parse(argv).args
+    assert type(args) is argslib.ArgsView
+    assert args == ["a", "b", "c", "d"]
+    assert len(args) == 4
+    assert args[-1] == "d"
+    assert args[1:3] == ["b", "c"]
+    assert args[::-2] == ["d", "b"]
+    assert list(args) == ["a", "b", "c", "d"]
+    assert "c" in args
+    assert args * 2 == ["a", "b", "c", "d"] * 2
+    assert 2 * args == ["a", "b", "c", "d"] * 2
+    assert args < ["b"] and args > ["a"] and args <= ["a", "b", "c", "d"]
+    args.append("e")
+    args[0] = "z"
+    assert args == ["z", "b", "c", "d", "e"]
+    assert argv == ("--", "a", "b", "c", "d")
+
+
+def test_option_parsing_switch_iterator():
+    parser = argslib.ArgParser()
+    result = parser.parse(iter(["foo", "--", "--bar", "--baz"]))
+    assert result.args == ["foo", "--bar", "--baz"]
+
+
 # ------------------------------------------------------------------------------
 # Commands.
 # ------------------------------------------------------------------------------
@@ -264,3 +304,1446 @@ def test_command_with_options():
     assert parser.command_parser.found("foo") == True
     assert parser.command_parser.value("bar") == "barval"
     assert len(parser.command_parser.args) == 2
+
+
+def test_command_callback():
+    found = []
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd", callback=lambda name, result: found.append(result.found("foo")))
+    cmd_parser.flag("foo")
+    parser.parse(["cmd", "--foo"])
+    assert found == [True]
+
+
+# ------------------------------------------------------------------------------
+# Parse results.
+# ------------------------------------------------------------------------------
+
+
+def test_parse_returns_result():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b")
+    result = parser.parse(["-f", "--bar", "baz", "arg"])
+    assert result.found("foo") == True
+    assert result.value("bar") == "baz"
+    assert result.args == ["arg"]
+
+
+def test_results_are_independent():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b")
+    result1 = parser.parse(["-ff", "--bar", "baz"])
+    result2 = parser.parse(["arg"])
+    assert result1.count("foo") == 2
+    assert result1.value("bar") == "baz"
+    assert result2.count("foo") == 0
+    assert result2.value("bar") == None
+    assert result2.args == ["arg"]
+
+
+def test_command_results_are_independent():
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd")
+    cmd_parser.flag("foo")
+    result1 = parser.parse(["cmd", "--foo"])
+    result2 = parser.parse(["cmd"])
+    assert result1.command_parser.found("foo") == True
+    assert result2.command_parser.found("foo") == False
+    assert cmd_parser.found("foo") == False
+
+
+def test_parse_from_threads():
+    import threading
+    parser = argslib.ArgParser()
+    parser.option("num n", type=int)
+    errors = []
+
+    def worker(n):
+        for _ in range(200):
+            result = parser.parse(["--num", str(n)] * n)
+            if result.values("num") != [n] * n:
+                errors.append(n)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+# ------------------------------------------------------------------------------
+# Compiled parsers.
+# ------------------------------------------------------------------------------
+
+
+def test_compiled_flags_and_options():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b", type=int)
+    parser.compile()
+    result = parser.parse(["-f", "--foo", "-ff", "--bar", "1", "-b", "2", "--bar=3", "arg"])
+    assert result.count("foo") == 4
+    assert result.values("bar") == [1, 2, 3]
+    assert result.args == ["arg"]
+
+
+def test_compiled_registration_after_compile():
+    parser = argslib.ArgParser().compile()
+    parser.flag("foo f")
+    cmd_parser = parser.command("cmd")
+    cmd_parser.option("bar b")
+    result = parser.parse(["-f", "cmd"])
+    assert result.found("foo") == True
+    assert result.args == ["cmd"]
+    result = parser.parse(["cmd", "-b", "baz"])
+    assert result.command_parser.value("bar") == "baz"
+
+
+def test_compiled_missing_value():
+    parser = argslib.ArgParser()
+    parser.option("bar b")
+    parser.compile()
+    with pytest.raises(SystemExit):
+        parser.parse(["--bar"])
+
+
+def test_compiled_option_value_after_switch():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.compile()
+    result = parser.parse(["--", "--foo", "-f"])
+    assert result.found("foo") == False
+    assert result.args == ["--foo", "-f"]
+
+
+# ------------------------------------------------------------------------------
+# Bulk parsing.
+# ------------------------------------------------------------------------------
+
+
+def fail_callback(name, result):
+    pytest.fail("callback called")
+
+
+def make_bulk_parser():
+    parser = argslib.ArgParser(helptext="usage")
+    parser.flag("foo f")
+    parser.option("bar b", type=int, default=0)
+    parser.command("cmd", callback=fail_callback)
+    return parser
+
+
+BULK_ARGVS = [
+    ["-ff", "arg1"],
+    ["--bar", "1", "--bar", "2"],
+    ["cmd", "arg2", "arg3"],
+    ["--bar", "oops"],
+    ["--help"],
+    [],
+]
+
+
+def test_parse_many():
+    columns = make_bulk_parser().parse_many(BULK_ARGVS, chunksize=4)
+    assert columns.size == 6
+    assert list(columns.status) == [0, 0, 0, 1, 2, 0]
+    assert list(columns.count("foo")) == [2, 0, 0, 0, 0, 0]
+    assert list(columns.count("b")) == [0, 2, 0, 0, 0, 0]
+    assert columns.value("bar") == [0, 2, 0, 0, 0, 0]
+    assert columns.args_for(0) == ["arg1"]
+    assert columns.args_for(2) == []
+    assert columns.command_for(2) == "cmd"
+    assert columns.command_for(0) == None
+
+
+def test_parse_many_processes():
+    serial = make_bulk_parser().parse_many(BULK_ARGVS)
+    columns = make_bulk_parser().parse_many(BULK_ARGVS * 3, chunksize=4, processes=2)
+    assert columns.size == 18
+    assert list(columns.status) == list(serial.status) * 3
+    assert list(columns.count("foo")) == list(serial.count("foo")) * 3
+    assert columns.value("bar") == serial.value("bar") * 3
+    assert list(columns.offsets) == [0, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3]
+    assert [columns.command_for(row) for row in range(18)] == ["cmd" if row % 6 == 2 else None for row in range(18)]
+
+
+def test_parse_many_worker_state():
+    import pickle
+    parser = make_bulk_parser()
+    argslib._init_worker(parser)
+    state = pickle.loads(pickle.dumps(argslib._parse_worker_chunk(BULK_ARGVS)))
+    assert not {"parser", "_flags", "_options"} & set(state)
+    columns = argslib.ParseColumns(parser)
+    columns._extend(argslib.ParseColumns._from_worker_state(state))
+    assert list(columns.count("foo")) == list(parser.parse_many(BULK_ARGVS).count("foo"))
+
+
+# ------------------------------------------------------------------------------
+# Argument streams.
+# ------------------------------------------------------------------------------
+
+
+def test_parse_iterator():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b")
+    result = parser.parse(iter(["-f", "--bar", "baz", "arg"]))
+    assert result.found("foo") == True
+    assert result.value("bar") == "baz"
+    assert result.args == ["arg"]
+
+
+def test_parse_iterator_missing_value():
+    parser = argslib.ArgParser()
+    parser.option("bar b")
+    with pytest.raises(SystemExit):
+        parser.parse(arg for arg in ["--bar"])
+
+
+def test_read_args_nul_separated():
+    import io
+    file = io.BytesIO(b"foo\0bar baz\0\xc3\xa9\0")
+    assert list(argslib.read_args(file, sep="\0", blocksize=3)) == ["foo", "bar baz", "é"]
+
+
+def test_read_args_newline_separated():
+    import io
+    file = io.BytesIO(b"foo\nbar\nbaz")
+    assert list(argslib.read_args(file, blocksize=2)) == ["foo", "bar", "baz"]
+
+
+def test_read_args_invalid_unicode():
+    import io
+    file = io.BytesIO(b"foo\n\xff\n")
+    with pytest.raises(argslib.InvalidUnicode):
+        list(argslib.read_args(file))
+
+
+# ------------------------------------------------------------------------------
+# Response files.
+# ------------------------------------------------------------------------------
+
+
+def test_response_file(tmp_path):
+    path = tmp_path / "args.rsp"
+    path.write_bytes(b"--foo\n  --bar 'baz qux'  \"a \\\"b\\\"\" c\\ d\n")
+    parser = argslib.ArgParser()
+    parser.flag("foo")
+    parser.option("bar")
+    parser.enable_response_files = True
+    result = parser.parse([f"@{path}", "arg"])
+    assert result.found("foo") == True
+    assert result.value("bar") == "baz qux"
+    assert result.args == ['a "b"', "c d", "arg"]
+
+
+def test_response_file_nested(tmp_path):
+    inner = tmp_path / "inner.rsp"
+    inner.write_text("b c")
+    outer = tmp_path / "outer.rsp"
+    outer.write_text(f"a @{inner} d")
+    parser = argslib.ArgParser()
+    parser.enable_response_files = True
+    assert parser.parse([f"@{outer}", "e"]).args == ["a", "b", "c", "d", "e"]
+
+
+def test_response_file_cycle(tmp_path):
+    path = tmp_path / "args.rsp"
+    path.write_text(f"a @{path}")
+    parser = argslib.ArgParser()
+    parser.enable_response_files = True
+    with pytest.raises(argslib.ArgsError):
+        parser.parse([f"@{path}"])
+
+
+@pytest.mark.parametrize("text", [b"a 'b c", b'x "y\\" z', b"a \\", b"'"])
+def test_response_file_unterminated(tmp_path, text):
+    path = tmp_path / "args.rsp"
+    path.write_bytes(text)
+    parser = argslib.ArgParser()
+    parser.enable_response_files = True
+    with pytest.raises(argslib.ArgsError):
+        parser.parse([f"@{path}"])
+
+
+def test_response_file_disabled_or_missing(tmp_path):
+    path = tmp_path / "args.rsp"
+    path.write_text("a")
+    parser = argslib.ArgParser()
+    assert parser.parse([f"@{path}"]).args == [f"@{path}"]
+    parser.enable_response_files = True
+    assert parser.parse(["@missing", "@"]).args == ["@missing", "@"]
+
+
+def test_response_file_empty(tmp_path):
+    path = tmp_path / "args.rsp"
+    path.write_text("")
+    parser = argslib.ArgParser()
+    parser.enable_response_files = True
+    assert parser.parse([f"@{path}", "a"]).args == ["a"]
+
+
+def test_response_file_cache(tmp_path):
+    path = tmp_path / "args.rsp"
+    path.write_text("a b")
+    parser = argslib.ArgParser()
+    parser.enable_response_files = True
+    parser.cache_response_files = True
+    assert parser.parse([f"@{path}"]).args == ["a", "b"]
+    assert parser.parse([f"@{path}", f"@{path}"]).args == ["a", "b", "a", "b"]
+    path.write_text("c d e")
+    assert parser.parse([f"@{path}"]).args == ["c", "d", "e"]
+
+
+# ------------------------------------------------------------------------------
+# Bytes arguments.
+# ------------------------------------------------------------------------------
+
+
+def test_bytes_args():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b")
+    parser.option("num n", type=int)
+    result = parser.parse([b"-f", b"--bar", b"\xff", b"-n=12", b"--bar=\xfe", b"arg\xfd", b"--", b"-x"])
+    assert result.found("foo") == True
+    assert result.values("bar") == [b"\xff", b"\xfe"]
+    assert result.value("num") == 12
+    assert result.args == [b"arg\xfd", b"-x"]
+
+
+def test_bytes_args_command():
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd")
+    cmd_parser.flag("foo")
+    result = parser.parse([b"cmd", b"--foo", b"\xff"])
+    assert result.command_name == "cmd"
+    assert result.command_parser.found("foo") == True
+    assert result.command_parser.args == [b"\xff"]
+
+
+def test_bytes_mode_argv(monkeypatch):
+    import os
+    monkeypatch.setattr("sys.argv", ["app", "--bar", os.fsdecode(b"\xff"), "arg"])
+    parser = argslib.ArgParser()
+    parser.option("bar")
+    with pytest.raises(argslib.InvalidUnicode):
+        parser.parse()
+    parser.bytes_mode = True
+    result = parser.parse()
+    assert result.value("bar") == b"\xff"
+    assert result.args == [b"arg"]
+
+
+def test_argv_switch_view(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["app", "--", "a", "b"])
+    args = argslib.ArgParser().parse().args
+    assert type(args) is argslib.ArgsView
+    assert args == ["a", "b"]
+
+
+def test_ascii_argv(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["app", "--bar", "é", "arg"])
+    parser = argslib.ArgParser()
+    parser.option("bar")
+    result = parser.parse()
+    assert result.value("bar") == "é"
+    assert result.args == ["arg"]
+
+
+# ------------------------------------------------------------------------------
+# Lazy options.
+# ------------------------------------------------------------------------------
+
+
+def test_lazy_option_converts_on_demand():
+    calls = []
+
+    def convert(str_val):
+        calls.append(str_val)
+        return int(str_val)
+
+    parser = argslib.ArgParser()
+    parser.option("foo f", type=convert, lazy=True)
+    result = parser.parse(["-f", "1", "-f", "2", "-f", "3"])
+    assert calls == []
+    assert result.count("foo") == 3
+    assert result.value("foo") == 3
+    assert result.value("foo") == 3
+    assert calls == ["3"]
+    assert result.values("foo") == [1, 2, 3]
+    assert calls == ["3", "1", "2"]
+
+
+def test_lazy_option_default():
+    parser = argslib.ArgParser()
+    parser.option("foo f", type=int, default=7, lazy=True)
+    assert parser.parse([]).value("foo") == 7
+
+
+def test_lazy_option_invalid_value(capsys):
+    parser = argslib.ArgParser()
+    parser.option("foo f", type=int, lazy=True)
+    result = parser.parse(["-f", "bad", "-f", "2"])
+    assert result.value("foo") == 2
+    with pytest.raises(SystemExit) as err:
+        result.values("foo")
+    assert "'bad'" in str(err.value.code)
+
+
+def test_lazy_option_validate():
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd")
+    cmd_parser.option("foo f", type=int, lazy=True)
+    assert parser.parse(["cmd", "-f", "1"]).validate().command_parser.value("foo") == 1
+    with pytest.raises(SystemExit):
+        parser.parse(["cmd", "-f", "bad"]).validate()
+
+
+# ------------------------------------------------------------------------------
+# Command loaders.
+# ------------------------------------------------------------------------------
+
+
+def load_cmd(cmd_parser):
+    cmd_parser.flag("foo f")
+    cmd_parser.helptext = "cmd help"
+
+
+def test_command_loader_callable():
+    loaded = []
+
+    def loader(cmd_parser):
+        loaded.append(cmd_parser)
+        load_cmd(cmd_parser)
+
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd", loader=loader)
+    parser.command("other", loader=lambda cmd_parser: pytest.fail("loader called"))
+    assert parser.parse(["arg"]).args == ["arg"]
+    assert loaded == []
+    result = parser.parse(["cmd", "--foo"])
+    assert result.command_parser.found("foo") == True
+    result = parser.parse(["cmd", "-f"])
+    assert loaded == [cmd_parser]
+
+
+def test_command_loader_string():
+    parser = argslib.ArgParser()
+    parser.command("cmd", loader="test_argslib:load_cmd")
+    assert parser.parse(["cmd", "-f"]).command_parser.found("foo") == True
+
+
+def test_command_loader_help(capsys):
+    parser = argslib.ArgParser()
+    parser.command("cmd", loader=load_cmd)
+    with pytest.raises(SystemExit):
+        parser.parse(["help", "cmd"])
+    assert capsys.readouterr().out == "cmd help\n"
+
+
+# ------------------------------------------------------------------------------
+# Completion scripts.
+# ------------------------------------------------------------------------------
+
+
+def make_completion_parser():
+    parser = argslib.ArgParser(helptext="usage")
+    parser.flag("foo f")
+    parser.option("mode m", complete=["fast", "slow"])
+    cmd_parser = parser.command("boo b")
+    cmd_parser.option("dir d", complete="dir")
+    cmd_parser.command("sub").flag("deep")
+    return parser
+
+
+def run_bash_completion(script, words):
+    import shutil
+    import subprocess
+    if not shutil.which("bash"):
+        pytest.skip("bash not available")
+    program = script + f"""
+COMP_WORDS=({" ".join(repr(word) for word in words)})
+COMP_CWORD={len(words) - 1}
+_argslib_tool
+echo "${{COMPREPLY[*]}}"
+"""
+    return subprocess.run(["bash", "-c", program], capture_output=True, text=True).stdout.split()
+
+
+def test_bash_completion():
+    script = make_completion_parser().completion_script("bash", "tool")
+    assert run_bash_completion(script, ["tool", ""]) == ["boo", "b", "help"]
+    assert run_bash_completion(script, ["tool", "--"]) == ["--foo", "--help", "--mode"]
+    assert run_bash_completion(script, ["tool", "-m", "s"]) == ["slow"]
+    assert run_bash_completion(script, ["tool", "b", ""]) == ["sub", "help"]
+    assert run_bash_completion(script, ["tool", "b", "sub", "--"]) == ["--deep"]
+    assert run_bash_completion(script, ["tool", "-f", "boo", ""]) == []
+
+
+def test_zsh_completion():
+    script = make_completion_parser().completion_script("zsh", "tool")
+    assert script.startswith("autoload -U +X bashcompinit && bashcompinit\n")
+    assert "complete -o bashdefault -o default -F _argslib_tool 'tool'" in script
+
+
+def test_fish_completion():
+    script = make_completion_parser().completion_script("fish", "tool")
+    assert """complete -c 'tool' -n 'string match -q -- ":*" (__argslib_tool_state)' -l mode -s m -x -a 'fast slow'""" in script
+    assert """complete -c 'tool' -n 'test (__argslib_tool_state) = " boo:1"' -f -a 'sub help'""" in script
+
+
+def test_completion_invalid_shell():
+    with pytest.raises(argslib.ArgsError):
+        make_completion_parser().completion_script("csh", "tool")
+
+
+# ------------------------------------------------------------------------------
+# Server mode.
+# ------------------------------------------------------------------------------
+
+
+def serve_test_parser(path):
+    import os
+    import time
+
+    def cmd_sleep(name, result):
+        time.sleep(float(result.args[0]))
+
+    parser = argslib.ArgParser(helptext="usage")
+    parser.flag("cwd")
+    parser.option("env")
+    parser.command("sleep", callback=cmd_sleep)
+
+    def main(result):
+        if result.found("cwd"):
+            print(os.getcwd())
+        if result.found("env"):
+            print(os.environ[result.value("env")])
+        print(" ".join(result.args))
+
+    parser.serve(path, main)
+
+
+@pytest.fixture
+def server(tmp_path):
+    import multiprocessing
+    import os
+    import time
+    if not hasattr(os, "fork"):
+        pytest.skip("server mode requires fork")
+    path = str(tmp_path / "server.sock")
+    process = multiprocessing.get_context("fork").Process(target=serve_test_parser, args=(path,))
+    process.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    yield path
+    process.terminate()
+    process.join()
+
+
+def run_client(path, argv, **kwargs):
+    import os
+    import subprocess
+    import sys
+    code = f"import argslib, sys; sys.exit(argslib.run_client({path!r}, {argv!r}))"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), ARGSLIB_TEST="foo")
+    return subprocess.Popen(
+        [sys.executable, "-c", code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **kwargs
+    )
+
+
+def test_server_request(server, tmp_path):
+    client = run_client(server, ["--cwd", "--env", "ARGSLIB_TEST", "a", "b"], cwd=tmp_path)
+    stdout, stderr = client.communicate()
+    assert client.returncode == 0
+    assert stdout == f"{tmp_path}\nfoo\na b\n"
+
+
+def test_server_socket_permissions(server):
+    import os
+    import stat
+    client = run_client(server, ["a"])
+    client.communicate()
+    assert stat.S_IMODE(os.stat(server).st_mode) == 0o600
+
+
+def test_server_refuses_non_socket(tmp_path):
+    path = tmp_path / "victim"
+    path.write_text("data")
+    with pytest.raises(argslib.ArgsError):
+        argslib.ArgParser().serve(str(path))
+    assert path.read_text() == "data"
+
+
+def test_server_exit_help_and_error(server):
+    client = run_client(server, ["--help"])
+    assert client.communicate() == ("usage\n", "")
+    assert client.returncode == 0
+    client = run_client(server, ["--bad"])
+    assert client.communicate() == ("", "Error: --bad is not a recognised flag or option name.\n")
+    assert client.returncode == 1
+
+
+def test_server_forwards_signals(server):
+    import signal
+    import time
+    client = run_client(server, ["sleep", "30"])
+    time.sleep(0.5)
+    client.send_signal(signal.SIGTERM)
+    client.communicate(timeout=10)
+    assert client.returncode == -signal.SIGTERM
+
+
+# ------------------------------------------------------------------------------
+# Instrumentation.
+# ------------------------------------------------------------------------------
+
+
+def test_instrumentation_events():
+    events = []
+    instr = argslib.Instrumentation()
+    instr.on("token", lambda parser, token, kind: events.append((token, kind)))
+    instr.on("flag", lambda name, count: events.append(("flag", name, count)))
+    instr.on("option", lambda name, value, seconds: events.append(("option", name, value)))
+    instr.on("command", lambda name: events.append(("command", name)))
+    instr.on("callback", lambda name, seconds: events.append(("callback", name)))
+
+    parser = argslib.ArgParser()
+    parser.instrumentation = instr
+    cmd_parser = parser.command("cmd", callback=lambda name, result: None)
+    cmd_parser.flag("foo f")
+    cmd_parser.option("bar b", type=int)
+    parser.parse(["cmd", "-f", "--bar=1", "arg"])
+
+    assert events == [
+        ("cmd", "command"),
+        ("command", "cmd"),
+        ("-f", "short"),
+        ("flag", "foo", 1),
+        ("--bar=1", "equals"),
+        ("option", "bar", "1"),
+        ("arg", "positional"),
+        ("callback", "cmd"),
+    ]
+    assert instr.counters["token:short"] == 1
+    assert instr.counters["flag"] == 1
+    assert set(instr.timings) == {"parse", "convert", "callbacks"}
+
+
+def test_instrumentation_lazy_option():
+    instr = argslib.Instrumentation()
+    parser = argslib.ArgParser()
+    parser.instrumentation = instr
+    parser.option("bar b", type=int, lazy=True)
+    result = parser.parse(["-b", "1", "-b", "2"])
+    assert "option" not in instr.counters
+    assert result.value("bar") == 2
+    assert instr.counters["option"] == 1
+
+
+def test_instrumentation_reports():
+    import json
+    instr = argslib.Instrumentation()
+    parser = argslib.ArgParser()
+    parser.instrumentation = instr
+    parser.flag("foo")
+    parser.parse(["--foo", "--foo"])
+    assert json.loads(instr.to_json())["counters"]["flag"] == 2
+    assert "  flag: 2" in instr.report()
+
+
+def test_instrumentation_env_variable():
+    import os
+    import subprocess
+    import sys
+    code = "import argslib; p = argslib.ArgParser(); p.flag('foo'); p.parse(['--foo'])"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), ARGSLIB_PROFILE="json")
+    process = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    assert process.stdout == ""
+    assert '"token:long": 1' in process.stderr
+
+
+# ------------------------------------------------------------------------------
+# Abbreviations.
+# ------------------------------------------------------------------------------
+
+
+def make_abbreviation_parser():
+    parser = argslib.ArgParser(helptext="usage", version="1.0")
+    parser.enable_abbreviations = True
+    parser.flag("verbose verbosity")
+    parser.flag("quiet")
+    parser.option("output")
+    parser.option("outfile")
+    parser.command("status")
+    parser.command("stash")
+    return parser
+
+
+def test_abbreviated_long_options():
+    parser = make_abbreviation_parser()
+    result = parser.parse(["--verb", "--q", "--outp", "a", "--outf=b"])
+    assert result.count("verbose") == 1
+    assert result.found("quiet") == True
+    assert result.value("output") == "a"
+    assert result.value("outfile") == "b"
+
+
+def test_abbreviated_command():
+    parser = make_abbreviation_parser()
+    result = parser.parse(["stat", "arg"])
+    assert result.command_name == "status"
+    assert result.command_parser.args == ["arg"]
+
+
+def test_abbreviated_help_flag(capsys):
+    parser = make_abbreviation_parser()
+    with pytest.raises(SystemExit):
+        parser.parse(["--he"])
+    assert capsys.readouterr().out == "usage\n"
+
+
+def test_ambiguous_abbreviations():
+    parser = make_abbreviation_parser()
+    with pytest.raises(SystemExit) as err:
+        parser.parse(["--ver"])
+    assert err.value.code == "Error: --ver is ambiguous, could be --verbose, --verbosity, --version."
+    with pytest.raises(SystemExit) as err:
+        parser.parse(["--out", "a"])
+    assert err.value.code == "Error: --out is ambiguous, could be --outfile, --output."
+    with pytest.raises(SystemExit) as err:
+        parser.parse(["st"])
+    assert err.value.code == "Error: 'st' is ambiguous, could be stash, status."
+
+
+def test_abbreviations_equals_non_option():
+    parser = make_abbreviation_parser()
+    for arg, name in [
+        ("--verbose=1", "verbose"),
+        ("--quie=1", "quie"),
+        ("--help=1", "help"),
+        ("--versi=1", "versi"),
+    ]:
+        with pytest.raises(SystemExit) as err:
+            parser.parse([arg])
+        assert err.value.code.startswith(f"Error: '{name}' is not a recognised option name")
+
+
+def test_abbreviations_disabled():
+    parser = make_abbreviation_parser()
+    parser.enable_abbreviations = False
+    assert parser.parse(["stat"]).args == ["stat"]
+    with pytest.raises(SystemExit):
+        parser.parse(["--verb"])
+
+
+def test_abbreviations_unknown_name():
+    parser = make_abbreviation_parser()
+    assert parser.parse(["xyz"]).args == ["xyz"]
+    with pytest.raises(SystemExit):
+        parser.parse(["--xyz"])
+    with pytest.raises(SystemExit):
+        parser.parse(["--=1"])
+
+
+# ------------------------------------------------------------------------------
+# Suggestions.
+# ------------------------------------------------------------------------------
+
+
+def make_suggestion_parser():
+    parser = argslib.ArgParser()
+    parser.flag("verbose verbosity v")
+    parser.flag("version-info")
+    parser.option("output o")
+    parser.command("status")
+    parser.command("stash")
+    return parser
+
+
+def error_message(parser, args):
+    with pytest.raises(SystemExit) as err:
+        parser.parse(args)
+    return err.value.code
+
+
+def test_suggestions_long_options():
+    parser = make_suggestion_parser()
+    assert error_message(parser, ["--verbos"]) == \
+        "Error: --verbos is not a recognised flag or option name (did you mean --verbose?)."
+    assert error_message(parser, ["--ouptut=a"]) == \
+        "Error: 'ouptut' is not a recognised option name (did you mean --output?)."
+    assert error_message(parser, ["--xyz"]) == \
+        "Error: --xyz is not a recognised flag or option name."
+
+
+def test_suggestions_short_options():
+    parser = make_suggestion_parser()
+    assert error_message(parser, ["-verbose"]) == \
+        "Error: 'e' in -verbose is not a recognised flag or option name (did you mean --verbose?)."
+
+
+def test_suggestions_commands():
+    parser = make_suggestion_parser()
+    assert error_message(parser, ["help", "stas"]) == \
+        "Error: 'stas' is not a recognised command (did you mean stash or status?)."
+
+
+def test_suggestions_configuration():
+    parser = make_suggestion_parser()
+    parser.max_suggestions = 1
+    assert error_message(parser, ["help", "stas"]) == \
+        "Error: 'stas' is not a recognised command (did you mean stash?)."
+    parser.max_suggestions = 0
+    assert error_message(parser, ["help", "stas"]) == "Error: 'stas' is not a recognised command."
+    parser.max_suggestions = 3
+    parser.suggestion_distance = 1
+    assert error_message(parser, ["help", "statu"]) == \
+        "Error: 'statu' is not a recognised command (did you mean status?)."
+
+
+def test_bk_tree_matches_linear_scan():
+    import random
+    rng = random.Random(1)
+    names = {"".join(rng.choice("abcde") for _ in range(rng.randint(1, 8))): object() for _ in range(500)}
+    tree = argslib._BKTree(names)
+    for _ in range(50):
+        query = "".join(rng.choice("abcde") for _ in range(rng.randint(1, 8)))
+        expected = sorted(
+            (argslib._edit_distance(query, name), name) for name in names
+            if argslib._edit_distance(query, name) <= 2
+            and argslib._edit_distance(query, name) * 3 <= max(len(query), len(name))
+        )
+        assert tree.search(query, 2, 1000) == [name for _, name in expected]
+
+
+# ------------------------------------------------------------------------------
+# Large specifications.
+# ------------------------------------------------------------------------------
+
+
+def test_large_spec():
+    parser = argslib.ArgParser()
+    for i in range(20):
+        cmd_parser = parser.command(f"cmd{i}")
+        for j in range(1000):
+            cmd_parser.flag(f"flag{j}")
+            cmd_parser.option(f"opt{j}", default=j)
+    result = parser.parse(["cmd7", "--flag999", "--opt0", "x"])
+    assert result.command_parser.found("flag999") == True
+    assert result.command_parser.found("flag998") == False
+    assert result.command_parser.value("opt0") == "x"
+    assert result.command_parser.value("opt500") == 500
+    assert result.command_parser.values("opt500") == []
+
+
+# ------------------------------------------------------------------------------
+# Async parsing.
+# ------------------------------------------------------------------------------
+
+
+def test_parse_async_callbacks():
+    calls = []
+
+    async def outer_callback(name, result):
+        calls.append((name, result.command_name))
+
+    def inner_callback(name, result):
+        calls.append((name, result.args))
+
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("outer", callback=outer_callback)
+    cmd_parser.command("inner", callback=inner_callback)
+    result = asyncio.run(parser.parse_async(["outer", "inner", "foo"]))
+    assert calls == [("inner", ["foo"]), ("outer", "inner")]
+    assert result.command_name == "outer"
+
+
+def test_parse_async_converters():
+    async def double(value):
+        await asyncio.sleep(0)
+        return int(value) * 2
+
+    parser = argslib.ArgParser()
+    cmd_parser = parser.command("cmd")
+    cmd_parser.option("foo", type=double)
+    cmd_parser.option("bar", type=double, default=0)
+
+    async def main():
+        return await parser.parse_async(["cmd", "--foo", "1", "--foo", "2"])
+
+    result = asyncio.run(main())
+    assert result.command_parser.values("foo") == [2, 4]
+    assert result.command_parser.value("bar") == 0
+
+
+def test_parse_async_invalid_value():
+    async def to_int(value):
+        return int(value)
+
+    parser = argslib.ArgParser()
+    parser.option("foo", type=to_int)
+    with pytest.raises(SystemExit):
+        asyncio.run(parser.parse_async(["--foo", "bar"]))
+
+
+def test_async_converter_sync_parse():
+    async def to_int(value):
+        return int(value)
+
+    parser = argslib.ArgParser()
+    parser.option("foo", type=to_int)
+    result = parser.parse(["--foo", "1"])
+    with pytest.raises(argslib.ArgsError):
+        result.value("foo")
+
+
+def test_parse_async_limit():
+    async def to_int(value):
+        return int(value)
+
+    parser = argslib.ArgParser()
+    parser.option("foo", type=to_int)
+    parser.limit("foo", min=1, max=5)
+    assert asyncio.run(parser.parse_async(["--foo", "3"])).value("foo") == 3
+    with pytest.raises(SystemExit) as err:
+        asyncio.run(parser.parse_async(["--foo", "9"]))
+    assert err.value.code == "Error: --foo must be between 1 and 5, found 9."
+
+
+# ------------------------------------------------------------------------------
+# Option fallbacks.
+# ------------------------------------------------------------------------------
+
+
+def make_config_parser(path):
+    parser = argslib.ArgParser()
+    parser.config_file = str(path)
+    parser.option("port", type=int, default=80, env="ARGSLIB_TEST_PORT", config="server.port")
+    parser.option("host", default="localhost", config="server.host")
+    return parser
+
+
+@pytest.mark.parametrize("filename, text", [
+    ("config.toml", "[server]\nport = 8080\n"),
+    ("config.ini", "[server]\nport = 8080\n"),
+    ("config.json", '{"server": {"port": 8080}}'),
+])
+def test_config_fallback(tmp_path, filename, text):
+    path = tmp_path / filename
+    path.write_text(text)
+    result = make_config_parser(path).parse([])
+    assert result.value("port") == 8080
+    assert result.value("host") == "localhost"
+    assert result.found("port") == False
+    assert result.count("port") == 0
+
+
+def test_env_fallback(tmp_path, monkeypatch):
+    path = tmp_path / "config.toml"
+    path.write_text("[server]\nport = 8080\n")
+    monkeypatch.setenv("ARGSLIB_TEST_PORT", "9090")
+    parser = make_config_parser(path)
+    assert parser.parse([]).value("port") == 9090
+    assert parser.parse(["--port", "7070"]).value("port") == 7070
+
+
+def test_config_missing_file(tmp_path):
+    result = make_config_parser(tmp_path / "missing.toml").parse([])
+    assert result.value("port") == 80
+
+
+def test_config_snapshot_cache(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text("[server]\nport = 8080\nunused = 1\n")
+    cache_dir = tmp_path / "cache"
+    parser = make_config_parser(path)
+    parser.config_cache_dir = str(cache_dir)
+    assert parser.parse([]).value("port") == 8080
+    snapshots = list(cache_dir.iterdir())
+    assert len(snapshots) == 1
+
+    argslib._config_file_cache.clear()
+    assert parser.parse([]).value("port") == 8080
+    assert list(cache_dir.iterdir()) == snapshots
+
+    path.write_text("[server]\nport = 8181\n")
+    assert parser.parse([]).value("port") == 8181
+
+
+def test_config_snapshot_cache_errors(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text('{"server": {"port": 8080}}')
+    (tmp_path / "notadir").write_text("")
+    parser = make_config_parser(path)
+    parser.config_cache_dir = str(tmp_path / "notadir" / "sub")
+    assert parser.parse([]).value("port") == 8080
+
+    argslib._config_file_cache.clear()
+    cache_dir = tmp_path / "cache"
+    parser.config_cache_dir = str(cache_dir)
+    parser.parse([]).value("port")
+    argslib._config_file_cache.clear()
+    for snapshot in cache_dir.iterdir():
+        snapshot.write_bytes(b"\x80garbage")
+    assert parser.parse([]).value("port") == 8080
+
+
+def test_config_fallback_conversion(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text('{"ratio": 3, "tags": ["a"]}')
+    parser = argslib.ArgParser()
+    parser.config_file = str(path)
+    parser.option("ratio", type=float, config="ratio")
+    parser.option("tags", type=lambda value: value, config="tags")
+    result = parser.parse([])
+    assert type(result.value("ratio")) is float
+    result.value("tags").append("b")
+    assert parser.parse([]).value("tags") == ["a"]
+
+
+# ------------------------------------------------------------------------------
+# Batch converters.
+# ------------------------------------------------------------------------------
+
+
+def test_batch_int_array():
+    parser = argslib.ArgParser()
+    parser.option("point p", type=argslib.int_array)
+    result = parser.parse(["--point", "1", "-p", "2", "--point=3"])
+    assert result.values("point") == array.array("q", [1, 2, 3])
+    assert result.value("point") == 3
+    assert result.count("point") == 3
+
+
+def test_batch_float_array_in_command():
+    parser = argslib.ArgParser()
+    parser.option("scale", type=argslib.float_array)
+    cmd_parser = parser.command("plot")
+    cmd_parser.option("point", type=argslib.float_array)
+    result = parser.parse(["plot", "--point", "1.5", "--point", "2.5"])
+    assert result.values("scale") == []
+    assert result.command_parser.values("point") == array.array("d", [1.5, 2.5])
+
+
+def test_batch_custom_callable():
+    parser = argslib.ArgParser()
+    parser.option("word", type=argslib.Batch(lambda words: sorted(set(words))))
+    result = parser.parse(["--word", "b", "--word", "a", "--word", "b"])
+    assert result.values("word") == ["a", "b"]
+
+
+def test_batch_env_fallback(monkeypatch):
+    parser = argslib.ArgParser()
+    parser.option("point", type=argslib.int_array, env="ARGSLIB_TEST_POINT")
+    monkeypatch.setenv("ARGSLIB_TEST_POINT", "42")
+    assert parser.parse([]).value("point") == 42
+    assert parser.parse(["--point", "7"]).value("point") == 7
+    monkeypatch.setenv("ARGSLIB_TEST_POINT", "x")
+    with pytest.raises(SystemExit):
+        parser.parse([]).value("point")
+
+
+def test_batch_invalid_value():
+    parser = argslib.ArgParser()
+    parser.option("point", type=argslib.int_array)
+    assert error_message(parser, ["--point", "1", "--point", "x2", "--point", "y"]) == (
+        "Error: invalid option value 'x2'."
+    )
+
+
+# ------------------------------------------------------------------------------
+# Help text.
+# ------------------------------------------------------------------------------
+
+
+def test_callable_helptext(capsys):
+    calls = []
+
+    def helptext(parser):
+        calls.append(parser)
+        return "Usage: app"
+
+    parser = argslib.ArgParser(helptext)
+    parser.parse([])
+    assert calls == []
+    with pytest.raises(SystemExit):
+        parser.parse(["--help"])
+    assert calls == [parser]
+    assert capsys.readouterr().out == "Usage: app\n"
+
+
+def test_help_generator(capsys, monkeypatch):
+    monkeypatch.setenv("COLUMNS", "80")
+    parser = argslib.ArgParser(argslib.HelpGenerator("Usage: app [command]", "Does things."))
+    parser.flag("verbose V", helptext="Print more output.")
+    parser.option("count c", type=int, default=1, helptext="Number of things.")
+    parser.command("status", "Usage: app status\n\n  Show the status.")
+    with pytest.raises(SystemExit):
+        parser.parse(["--help"])
+    assert capsys.readouterr().out == (
+        "Usage: app [command]\n"
+        "\n"
+        "  Does things.\n"
+        "\n"
+        "Options:\n"
+        "  -c, --count <int>    Number of things. Default: 1.\n"
+        "\n"
+        "Flags:\n"
+        "  -V, --verbose        Print more output.\n"
+        "  -h, --help           Print this help text and exit.\n"
+        "\n"
+        "Commands:\n"
+        "  status               Show the status.\n"
+        "  help <command>       Print the specified command's help text.\n"
+    )
+
+
+def test_help_generator_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("COLUMNS", "80")
+    generator = argslib.HelpGenerator(cache_dir=str(tmp_path))
+    parser = argslib.ArgParser(generator)
+    parser.flag("foo", helptext="Foo.")
+    helptext = generator(parser)
+    assert [path.read_text() for path in tmp_path.iterdir()] == [helptext]
+    assert generator(parser) == helptext
+    parser.flag("bar", helptext="Bar.")
+    assert "--bar" in generator(parser)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_help_generator_unwritable_cache(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("")
+    generator = argslib.HelpGenerator("Usage: app", cache_dir=str(path / "cache"))
+    assert generator(argslib.ArgParser(generator)).startswith("Usage: app")
+
+
+# ------------------------------------------------------------------------------
+# Script mode.
+# ------------------------------------------------------------------------------
+
+
+def test_run_script(tmp_path, capsys):
+    calls = []
+    parser = argslib.ArgParser()
+    parser.flag("foo")
+    cmd_parser = parser.command("cmd", callback=lambda name, result: calls.append(result.args))
+    cmd_parser.option("num", type=int)
+    path = tmp_path / "script.txt"
+    path.write_text(
+        "# comment\n"
+        "cmd 'a b' c\n"
+        "\n"
+        "cmd --num x\n"
+        "--foo --foo\n"
+        "cmd \"unclosed\n"
+        "cmd d\n"
+    )
+    found = []
+    statuses = parser.run_script(str(path), main=lambda result: found.append(result.count("foo")))
+    assert statuses == [0, 1, 0, 1, 0]
+    assert calls == [["a b", "c"], ["d"]]
+    assert found == [0, 2, 0]
+    assert capsys.readouterr().err == (
+        "Error: invalid option value 'x'.\n"
+        "Error: no closing quotation.\n"
+    )
+
+
+def test_run_script_exit_status():
+    def main(result):
+        if result.args:
+            sys.exit(int(result.args[0]))
+
+    parser = argslib.ArgParser()
+    assert parser.run_script(io.StringIO("3\n\n0\n7 bar\n"), main) == [3, 0, 7]
+
+
+# ------------------------------------------------------------------------------
+# Constraints.
+# ------------------------------------------------------------------------------
+
+
+def make_constraint_parser():
+    parser = argslib.ArgParser()
+    parser.flag("json j")
+    parser.flag("yaml")
+    parser.option("output o")
+    parser.option("level", type=int)
+    parser.option("color")
+    parser.require("output")
+    parser.exclusive("json", "yaml")
+    parser.requires("yaml", "level")
+    parser.limit("level", min=1, max=5)
+    parser.limit("color", choices=["red", "blue"])
+    return parser
+
+
+def test_constraints_satisfied():
+    parser = make_constraint_parser()
+    result = parser.parse(["-o", "out", "--yaml", "--level", "5", "--color", "red"])
+    assert result.value("level") == 5
+
+
+def test_constraints_all_violations_reported():
+    parser = make_constraint_parser()
+    assert error_message(parser, ["--json", "--yaml", "--level", "9", "--color", "green"]) == (
+        "Error: --output is required; --json and --yaml cannot be used together; "
+        "--level must be between 1 and 5, found 9; --color must be one of red, blue, found green."
+    )
+    assert error_message(parser, ["-o", "out", "--yaml"]) == "Error: --yaml requires --level."
+
+
+def test_constraints_scoped_to_command():
+    calls = []
+    parser = argslib.ArgParser()
+    parser.option("name")
+    cmd_parser = parser.command("cmd", callback=lambda name, result: calls.append(name))
+    cmd_parser.option("name")
+    cmd_parser.require("name")
+    assert parser.parse([]).value("name") is None
+    assert parser.parse(["cmd", "--name", "x"]).command_parser.value("name") == "x"
+    assert error_message(parser, ["cmd"]) == "Error: --name is required."
+    assert calls == ["cmd"]
+
+
+def test_constraints_invalid_name():
+    parser = argslib.ArgParser()
+    parser.flag("foo")
+    with pytest.raises(argslib.InvalidName):
+        parser.require("bar")
+    with pytest.raises(argslib.InvalidName):
+        parser.limit("foo", min=1)
+
+
+# ------------------------------------------------------------------------------
+# Namespaces.
+# ------------------------------------------------------------------------------
+
+
+def test_namespace():
+    parser = argslib.ArgParser()
+    parser.flag("verbose v")
+    parser.option("dry-run", type=int, default=0)
+    parser.option("threshold t", type=float, default=0.5)
+    cmd_parser = parser.command("cmd")
+    cmd_parser.option("name")
+    result = parser.parse(["cmd", "--name", "x", "foo"])
+    ns = result.namespace()
+    assert (ns.verbose, ns.dry_run, ns.threshold) == (0, 0, 0.5)
+    assert ns.command_name == "cmd"
+    assert ns.command.name == "x"
+    assert ns.command.args == ["foo"]
+    assert ns.command.command is None
+    with pytest.raises(AttributeError):
+        ns.verbos
+    with pytest.raises(AttributeError):
+        ns.other = 1
+
+    ns = parser.parse(["-vv", "-t", "1.5", "bar"]).namespace()
+    assert (ns.verbose, ns.threshold, ns.args, ns.command) == (2, 1.5, ["bar"], None)
+
+
+def test_namespace_class_cached():
+    parser = argslib.ArgParser()
+    parser.flag("foo")
+    cls = type(parser.parse([]).namespace())
+    assert type(parser.parse(["--foo"]).namespace()) is cls
+    parser.flag("bar")
+    ns = parser.parse(["--bar"]).namespace()
+    assert type(ns) is not cls
+    assert (ns.foo, ns.bar) == (0, 1)
+
+
+# ------------------------------------------------------------------------------
+# Incremental parsing.
+# ------------------------------------------------------------------------------
+
+
+def make_incremental_parser():
+    parser = argslib.ArgParser()
+    parser.flag("foo f")
+    parser.option("bar b", type=int, default=0)
+    parser.option("point", type=argslib.int_array)
+    cmd_parser = parser.command("cmd")
+    cmd_parser.flag("baz z")
+    cmd_parser.option("qux q")
+    return parser
+
+
+def result_state(result):
+    state = []
+    while result is not None:
+        state.append((
+            {flag.name: count for flag, count in result._counts.items()},
+            {option.name: list(result._option_values(option)) for option in result._values},
+            list(result.args),
+            result.command_name,
+        ))
+        result = result.command_parser
+    return state
+
+
+def parse_or_error(parse, args):
+    try:
+        return result_state(parse(args))
+    except SystemExit as err:
+        return err.code
+
+
+def test_incremental_parse_typing():
+    parser = make_incremental_parser()
+    incremental = argslib.IncrementalParser(parser)
+    for tokens in (
+        ["-f", "--bar", "1", "--point", "2", "--point", "3", "arg", "--", "-f"],
+        ["cmd", "-zz", "--qux", "x", "arg", "--", "-f"],
+    ):
+        for i in range(len(tokens) + 1):
+            expected = parse_or_error(parser.parse, tokens[:i])
+            assert parse_or_error(incremental.parse, tokens[:i]) == expected
+        assert incremental._log.snapshots[-1].index == len(tokens) - 2
+
+
+def test_incremental_parse_reuses_result():
+    parser = make_incremental_parser()
+    incremental = argslib.IncrementalParser(parser)
+    args = [str(i) for i in range(1000)]
+    first = incremental.parse(args)
+    second = incremental.parse(args + ["--point", "1"])
+    assert second is first
+    assert len(second.args) == 1000
+    assert second.value("point") == 1
+    assert incremental.parse(args[:10]).args == args[:10]
+
+
+def test_incremental_parse_random_edits():
+    rng = random.Random(0)
+    vocabulary = ["-f", "-b", "--bar", "1", "x", "--point", "2", "cmd", "-z", "-q", "--", "foo"]
+    parser = make_incremental_parser()
+    incremental = argslib.IncrementalParser(parser)
+    for prefix in ([], ["cmd"], []):
+        args = []
+        for _ in range(300):
+            i = rng.randint(0, len(args))
+            if rng.random() < 0.6 or not args:
+                args = args[:i] + [rng.choice(vocabulary)] + args[i:]
+            else:
+                args = args[:i] + args[i + 1:]
+            expected = parse_or_error(parser.parse, prefix + args)
+            assert parse_or_error(incremental.parse, prefix + args) == expected
+
+
+# ------------------------------------------------------------------------------
+# Parse caching.
+# ------------------------------------------------------------------------------
+
+
+def test_parse_cache():
+    conversions = []
+    calls = []
+
+    def to_int(value):
+        conversions.append(value)
+        return int(value)
+
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache(maxsize=2)
+    cmd_parser = parser.command("cmd", callback=lambda name, result: calls.append(result))
+    cmd_parser.flag("foo")
+    cmd_parser.option("num", type=to_int)
+
+    first = parser.parse(["cmd", "--foo", "--num", "1", "arg"])
+    second = parser.parse(["cmd", "--foo", "--num", "1", "arg"])
+    assert conversions == ["1"]
+    assert calls == [first.command_parser, second.command_parser]
+    assert second is not first
+    assert second.command_parser.count("foo") == 1
+    assert second.command_parser.value("num") == 1
+    assert second.command_parser.args == ["arg"]
+    second.command_parser.args.append("other")
+    assert parser.parse(["cmd", "--foo", "--num", "1", "arg"]).command_parser.args == ["arg"]
+
+    cache = parser.parse_cache
+    assert (cache.hits, cache.misses, cache.evictions, len(cache)) == (2, 1, 0, 1)
+    parser.parse(["cmd"])
+    parser.parse(["cmd", "--num", "2"])
+    assert (cache.hits, cache.misses, cache.evictions, len(cache)) == (2, 3, 1, 2)
+
+
+def test_parse_cache_impure_converter():
+    counter = iter(range(100))
+
+    @argslib.impure
+    def next_id(value):
+        return next(counter)
+
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    parser.option("id", type=next_id)
+    assert parser.parse(["--id", "x"]).value("id") == 0
+    assert parser.parse(["--id", "x"]).value("id") == 1
+    assert len(parser.parse_cache) == 0
+
+
+def test_parse_cache_env_fallback(monkeypatch):
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    parser.option("port", type=int, env="ARGSLIB_TEST_PORT")
+    monkeypatch.setenv("ARGSLIB_TEST_PORT", "1")
+    assert parser.parse([]).value("port") == 1
+    monkeypatch.setenv("ARGSLIB_TEST_PORT", "2")
+    assert parser.parse([]).value("port") == 2
+    assert parser.parse_cache.hits == 1
+
+
+def test_parse_cache_mutable_value():
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    parser.option("data", type=json.loads)
+    parser.option("point", type=argslib.int_array)
+    parser.parse(["--data", "[1]"]).value("data").append(2)
+    assert parser.parse(["--data", "[1]"]).value("data") == [1]
+    assert len(parser.parse_cache) == 0
+    parser.parse(["--point", "1"])
+    assert parser.parse(["--point", "1"]).value("point") == 1
+    assert parser.parse_cache.hits == 1
+
+
+def test_parse_cache_spec_change():
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    assert parser.parse(["deploy"]).args == ["deploy"]
+    parser.command("deploy")
+    assert parser.parse(["deploy"]).command_name == "deploy"
+    assert parser.parse(["deploy", "now"]).command_parser.args == ["now"]
+    parser.commands["deploy"].command("now")
+    assert parser.parse(["deploy", "now"]).command_parser.command_name == "now"
+    assert parser.parse_cache.hits == 0
+
+
+def test_parse_cache_constraint_change():
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    parser.flag("a")
+    parser.flag("b")
+    parser.parse(["--a", "--b"])
+    parser.exclusive("a", "b")
+    with pytest.raises(SystemExit):
+        parser.parse(["--a", "--b"])
+
+
+def test_parse_cache_spec_change_scope():
+    parser = argslib.ArgParser()
+    parser.parse_cache = argslib.ParseCache()
+    parser.command("lazy", loader=lambda cmd_parser: cmd_parser.flag("foo"))
+    parser.parse(["arg"])
+    parser.parse(["lazy", "--foo"])
+    argslib.ArgParser().flag("unrelated")
+    parser.parse(["arg"])
+    parser.parse(["lazy", "--foo"])
+    assert parser.parse_cache.hits == 2